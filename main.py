@@ -6,13 +6,23 @@ import socket
 from pprint import pprint
 
 import tornado.ioloop
+import tornado.process
 from logzero import logger
 from rethinkdb import r
 from tornado.httpserver import HTTPServer
 from tornado.log import enable_pretty_logging
+from tornado.netutil import bind_sockets
 
+from web import settings
+from web.activity import activity
+from web.balancer import balancer
+from web.cooldown import cooldown
 from web.database import db
 from web.entry import make_app
+from web.quota import quota
+from web.registry import registry
+from web.reservation import reservations
+from web.resumable import sessions
 from web.views import OpenIdLoginHandler, SimpleLoginHandler, GithubLoginHandler
 
 
@@ -44,18 +54,20 @@ def main():
                         choices=_auth_handlers.keys(), help='authentication method')
     parser.add_argument("--no-xheaders", action="store_true",
                         help="disable support for X-Real-Ip/X-Forwarded-For")
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of server processes, 0 means number of cpus')
     parser.add_argument(
         '--auth-conf-file', type=argparse.FileType('r'), help='authentication config file')
     # yapf: enable
 
     args = parser.parse_args()
     print(args)
+    if args.debug and args.processes != 1:
+        parser.error("--debug can not be used with --processes")
     enable_pretty_logging()
 
     db.setup()
 
-    ioloop = tornado.ioloop.IOLoop.current()
-
     # TODO(ssx): for debug use
     # async def dbtest():
     #     items = await db.table("devices").get_all(
@@ -65,11 +77,36 @@ def main():
 
     # ioloop.spawn_callback(dbtest)
 
+    task_id = 0
+    if args.processes != 1:
+        # sockets are shared by all the forked processes
+        sockets = bind_sockets(args.port)
+        task_id = tornado.process.fork_processes(args.processes)
+        # providers may connect to any process, commands are routed by db
+        settings.REGISTRY_BROKER = "rethinkdb"
+
+    ioloop = tornado.ioloop.IOLoop.current()
+    # caches of this process, updated by the devices changefeed of it
+    quota.start()
+    activity.start()
+    balancer.start()
+    # heartbeat of this process, the leader elected among all the processes
+    # owns idle deadlines of using devices and removes dead nodes
+    registry.start()
+    if task_id == 0:  # reservations and files of this machine
+        ioloop.spawn_callback(reservations.restore)
+        cooldown.start_watchdog(settings.COOLDOWN_STALE_AFTER)
+        sessions.start_gc()
+
     login_handler = _auth_handlers[args.auth]
     app = make_app(login_handler, debug=args.debug)
     server = HTTPServer(app, xheaders=not args.no_xheaders)
-    server.listen(args.port)
-    logger.info("listen on port http://%s:%d", machine_ip(), args.port)
+    if args.processes != 1:
+        server.add_sockets(sockets)
+    else:
+        server.listen(args.port)
+    logger.info("listen on port http://%s:%d (task %d)", machine_ip(),
+                args.port, task_id)
     try:
         ioloop.start()
     except KeyboardInterrupt:
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Concurrent acquire benchmark, every device must be owned by exactly one user
+#
+# Requires a running rethinkdb (RDB_HOST, RDB_PORT, ...), a database named
+# RDB_DBNAME + "_bench" is used and dropped after the test.
+#
+# Usage: python scripts/bench_acquire.py [-c 500] [-d 20]
+#
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ["RDB_DBNAME"] = (os.getenv("RDB_DBNAME") or "atxserver2") + "_bench"
+
+from rethinkdb import r  # noqa: E402
+from tornado import gen  # noqa: E402
+from tornado.ioloop import IOLoop  # noqa: E402
+
+from web import settings  # noqa: E402
+from web.database import db, time_now  # noqa: E402
+from web.views.device import AcquireError, D  # noqa: E402
+
+
+async def run(concurrency: int, num_devices: int):
+    udids = ["bench-%04d" % i for i in range(num_devices)]
+    await db.table("devices").insert([{
+        "udid": udid,
+        "platform": "android",
+        "using": False,
+        "colding": False,
+        "createdAt": time_now(),
+        "sources": {"bench": {"id": "bench", "priority": 1}},
+    } for udid in udids], conflict="replace")  # yapf: disable
+
+    owners = {udid: [] for udid in udids}
+    reasons = {}
+    latencies = []
+
+    async def acquire(i: int):
+        udid = udids[i % num_devices]
+        email = "user%d@bench.io" % i
+        start = time.time()
+        try:
+            await D(udid).acquire(email, idle_timeout=3600)
+            owners[udid].append(email)
+        except AcquireError as e:
+            reasons[e.reason] = reasons.get(e.reason, 0) + 1
+        latencies.append(time.time() - start)
+
+    start = time.time()
+    await gen.multi([acquire(i) for i in range(concurrency)])
+    elapsed = time.time() - start
+
+    rows = await db.table("devices").get_all(*udids).pluck("udid", "userId").all()
+    ok = all(len(owners[d['udid']]) == 1 and owners[d['udid']][0] == d['userId']
+             for d in rows) # yapf: disable
+
+    latencies.sort()
+    print("acquirers: %d, devices: %d, elapsed: %.3fs, %.0f acquire/s" %
+          (concurrency, num_devices, elapsed, concurrency / elapsed))
+    print("latency p50: %.1fms, p99: %.1fms" %
+          (latencies[len(latencies) // 2] * 1000,
+           latencies[int(len(latencies) * 0.99)] * 1000))
+    print("failures by reason:", reasons)
+    print("exactly-once ownership:", "OK" if ok else "FAILED")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--concurrency", type=int, default=500,
+                        help="number of simultaneous acquirers")
+    parser.add_argument("-d", "--devices", type=int, default=20,
+                        help="number of devices competed for")
+    args = parser.parse_args()
+
+    db.setup()
+    try:
+        ok = IOLoop.current().run_sync(
+            lambda: run(args.concurrency, args.devices))
+    finally:
+        r.set_loop_type(None)
+        conn = r.connect(host=settings.RDB_HOST, port=settings.RDB_PORT,
+                         user=settings.RDB_USER, password=settings.RDB_PASSWD)
+        r.db_drop(settings.RDB_DBNAME).run(conn)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
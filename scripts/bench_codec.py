@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Benchmark websocket frame encodings (frames per second)
+#
+# Usage: python scripts/bench_codec.py [-n 20000]
+#
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+from rethinkdb import r
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from web.libs import codec  # noqa: E402
+
+
+def make_device(i: int) -> dict:
+    now = datetime.datetime.now(r.make_timezone("+08:00"))
+    return {
+        "udid": "udid-%06d" % i,
+        "platform": "android",
+        "present": True,
+        "using": i % 3 == 0,
+        "colding": False,
+        "owner": "",
+        "userId": None,
+        "createdAt": now,
+        "updatedAt": now,
+        "properties": {
+            "serial": "SERIAL%08d" % i,
+            "brand": "HUAWEI",
+            "model": "DUK-AL20",
+            "version": "8.0.0",
+            "sdk": 26,
+        },
+        "sources": {
+            "b0c1a0f2-0000-11e9-aaaa-%012d" % i: {
+                "atxAgentAddress": "10.0.0.1:20001",
+                "remoteConnectAddress": "10.0.0.1:20002",
+                "whatsInputAddress": "10.0.0.1:20003",
+                "secret": "6NC5Tls1",
+                "url": "http://10.0.1.1:3500",
+                "priority": 2,
+            }
+        },
+    }
+
+
+def bench(c, data, n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        c.loads(c.dumps(data))
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=20000, help="frames per case")
+    args = parser.parse_args()
+
+    heartbeat = {"command": "update", "udid": "udid-000001", "platform": "android",
+                 "provider": make_device(1)["sources"], "properties": make_device(1)["properties"]} # yapf: disable
+    change = {"event": "update", "token": "3f2a9c1d:120", "data": make_device(1)}
+    snapshot = {"event": "snapshot", "token": "3f2a9c1d:120",
+                "devices": [make_device(i) for i in range(500)]} # yapf: disable
+
+    cases = [
+        ("heartbeat update", heartbeat, args.n),
+        ("device change", change, args.n),
+        ("snapshot(500 devices)", snapshot, max(1, args.n // 500)),
+    ]
+    for name in ("json", "msgpack"):
+        try:
+            c = codec.get_codec(name)
+        except ValueError as e:
+            print("%-8s skip: %s" % (name, e))
+            continue
+        for title, data, n in cases:
+            size = len(c.dumps(data))
+            print("%-8s %-22s %8d bytes %12.0f frames/s" %
+                  (name, title, size, bench(c, data, n)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Benchmark MultiPartStreamer parsing throughput (MB/s)
+#
+# Usage: python scripts/bench_multipart.py [--sizes 100M,1G,4G] [--chunks 16K,1M] [--md5]
+#
+# Part data is hashed (--md5) or dropped, not written to disk, so only the
+# parser is measured. Body is generated on the fly, it is never kept in memory.
+#
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from web.views.multipart_streamer import MultiPartStreamer, StreamedPart  # noqa: E402
+
+BOUNDARY = b"----WebKitFormBoundary7MA4YWxkTrZu0gW"
+_UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(s: str) -> int:
+    s = s.strip().upper()
+    if s[-1] in _UNITS:
+        return int(float(s[:-1]) * _UNITS[s[-1]])
+    return int(s)
+
+
+class NullPart(StreamedPart):
+    def __init__(self, streamer, headers, md5=False):
+        super().__init__(streamer, headers)
+        self._m = hashlib.md5() if md5 else None
+
+    def feed(self, data):
+        if self._m:
+            self._m.update(data)
+
+
+def body_chunks(size: int, chunk_size: int):
+    """ yield chunks of a multipart body with one file part of size bytes """
+    yield (b"--" + BOUNDARY + b"\r\n"
+           b'Content-Disposition: form-data; name="file"; filename="big.apk"\r\n'
+           b"Content-Type: application/octet-stream\r\n\r\n")
+    chunk = os.urandom(chunk_size)
+    left = size
+    while left >= chunk_size:
+        yield chunk
+        left -= chunk_size
+    if left:
+        yield chunk[:left]
+    yield b"\r\n--" + BOUNDARY + b"--\r\n"
+
+
+def bench(size: int, chunk_size: int, md5: bool) -> float:
+    class Streamer(MultiPartStreamer):
+        def create_part(self, headers):
+            return NullPart(self, headers, md5)
+
+    ps = Streamer(size)
+    start = time.perf_counter()
+    for chunk in body_chunks(size, chunk_size):
+        ps.data_received(chunk)
+    ps.data_complete()
+    elapsed = time.perf_counter() - start
+    assert ps.parts[0].size == size, (ps.parts[0].size, size)
+    return size / elapsed / (1 << 20)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="100M,1G,4G", help="body sizes")
+    parser.add_argument("--chunks", default="16K,1M", help="chunk sizes")
+    parser.add_argument("--md5", action="store_true", help="hash part data like upload does") # yapf: disable
+    args = parser.parse_args()
+
+    print("%-8s %-8s %10s" % ("size", "chunk", "MB/s"))
+    for size in args.sizes.split(","):
+        for chunk in args.chunks.split(","):
+            speed = bench(parse_size(size), parse_size(chunk), args.md5)
+            print("%-8s %-8s %10.1f" % (size, chunk, speed))
+
+
+if __name__ == "__main__":
+    main()
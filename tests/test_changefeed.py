@@ -0,0 +1,112 @@
+# coding: utf-8
+#
+# run with: python -m pytest tests
+#
+
+import pytest
+
+from web.changefeed import DeviceChangeHub, DeviceFilter
+
+
+def publish(hub: DeviceChangeHub, udid: str, old=None):
+    hub._publish({"old_val": old, "new_val": {"udid": udid}})
+
+
+def test_token_round_trip():
+    hub = DeviceChangeHub(maxlen=10)
+    assert hub.replay(hub.token) == []
+    publish(hub, "a")
+    token = hub.token
+    assert token.endswith(":1")
+    assert hub.replay(token) == []
+    publish(hub, "b", old={"udid": "b"})
+    changes = hub.replay(token)
+    assert [c['seq'] for c in changes] == [2]
+    assert changes[0]['event'] == "update"
+    assert hub.make_token(changes[0]['seq']) == hub.token
+
+
+@pytest.mark.parametrize("token", [None, "", "nocolon", "abc:1", "x:y"])
+def test_invalid_token(token):
+    hub = DeviceChangeHub(maxlen=10)
+    publish(hub, "a")
+    assert hub.replay(token) is None
+
+
+def test_token_from_future_or_old_epoch():
+    hub = DeviceChangeHub(maxlen=10)
+    publish(hub, "a")
+    assert hub.replay(hub.make_token(5)) is None
+    token = hub.token
+    hub._new_epoch()  # changefeed reconnected
+    assert hub.replay(token) is None
+
+
+def test_replay_after_gap():
+    hub = DeviceChangeHub(maxlen=3)
+    start = hub.token
+    publish(hub, "a")
+    first = hub.token
+    for udid in ("b", "c", "d"):
+        publish(hub, udid)
+    # seq 1 is dropped from the log, resuming before it would miss a change
+    assert hub.replay(start) is None
+    changes = hub.replay(first)
+    assert [c['data']['udid'] for c in changes] == ["b", "c", "d"]
+
+
+def test_delete_event():
+    hub = DeviceChangeHub(maxlen=3)
+    hub._publish({"old_val": {"udid": "a"}, "new_val": None})
+    hub._publish({"old_val": None, "new_val": None})  # ignored
+    changes = hub.replay(hub.make_token(0))
+    assert len(changes) == 1
+    assert changes[0]['event'] == "delete"
+    assert changes[0]['data'] == {"udid": "a"}
+
+
+DEVICE = {
+    "udid": "u1",
+    "platform": "android",
+    "owner": "g1",
+    "properties": {"brand": "HUAWEI", "version": "9", "extra": {"a": 1}},
+}
+
+
+@pytest.mark.parametrize("filters, matched", [
+    (None, True),
+    ({"platform": "android"}, True),
+    ({"platform": ["apple", "android"]}, True),
+    ({"platform": "apple"}, False),
+    ({"owner": "g1"}, True),
+    ({"group": ["g2"]}, False),
+    ({"owner": "g2", "group": "g1"}, True),
+    ({"udids": ["u1", "u2"]}, True),
+    ({"udids": ["u2"]}, False),
+    ({"properties": {"brand": "HUAWEI", "version": ["8", "9"]}}, True),
+    ({"properties": {"brand": "Xiaomi"}}, False),
+    ({"properties": {"missing": "x"}}, False),
+    ({"properties": {"extra": "x"}}, False),  # not a scalar
+])
+def test_filter_match(filters, matched):
+    assert DeviceFilter(filters).match(DEVICE) is matched
+
+
+@pytest.mark.parametrize("filters", [
+    ["platform"],
+    {"unknown": 1},
+    {"platform": {"a": 1}},
+    {"udids": [["u1"]]},
+    {"properties": "brand"},
+    {"properties": {"brand": {"a": 1}}},
+])
+def test_invalid_filter(filters):
+    with pytest.raises(ValueError):
+        DeviceFilter(filters)
+
+
+def test_filter_equal():
+    a = DeviceFilter({"platform": ["android", "apple"], "properties": {"x": 1, "y": 2}}) # yapf: disable
+    b = DeviceFilter({"platform": ["apple", "android"], "properties": {"y": 2, "x": 1}}) # yapf: disable
+    assert a == b
+    assert a != DeviceFilter({"platform": "android"})
@@ -0,0 +1,109 @@
+# coding: utf-8
+#
+# coalesce lastActivatedAt updates of using devices
+#
+
+from rethinkdb import r
+from tornado.ioloop import PeriodicCallback
+
+from . import settings
+from .changefeed import hub
+from .database import db, time_now
+
+
+class ActivityTracker(object):
+    """
+    Keep-alive requests only update memory, lastActivatedAt of all devices
+    are written to database together every `flush_interval` seconds.
+
+    `owners` caches (userId, idleTimeout) of using devices, so that checking
+    owner of device does not need a database query every time. It is kept
+    up to date by the devices changefeed, so releases and acquires in other
+    server processes are seen too.
+    """
+
+    def __init__(self, flush_interval: float):
+        self.owners = {}  # udid -> (email, idle_timeout)
+        self._pending = {}  # udid -> (email, lastActivatedAt)
+        self._latest = {}  # udid -> lastActivatedAt
+        self._flush_interval = flush_interval
+        self._timer = None
+
+    def start(self):
+        hub.subscribe(self._on_change)
+
+    def _on_change(self, change: dict):
+        if change['event'] == "reset":  # changes may be lost
+            self.owners.clear()
+            return
+        device = change['data']
+        udid = device['udid']
+        if change['event'] == "delete" or not device.get('using'):
+            if udid in self.owners:
+                self.released(udid)
+            return
+        owner = self.owners.get(udid)
+        if owner and owner[0] != device.get('userId'):
+            self.released(udid)  # acquired by others
+        if device.get('userId') and device.get('idleTimeout') is not None:
+            self.owners[udid] = (device['userId'], device['idleTimeout'])
+
+    def acquired(self, udid: str, email: str, idle_timeout: int):
+        self.owners[udid] = (email, idle_timeout)
+
+    def released(self, udid: str):
+        self.owners.pop(udid, None)
+        self._pending.pop(udid, None)
+        self._latest.pop(udid, None)
+
+    @property
+    def max_delay(self) -> float:
+        """ seconds before keep-alive of any process is in database """
+        return self._flush_interval * 2
+
+    def touch(self, udid: str, email: str):
+        now = time_now()
+        self._pending[udid] = (email, now)
+        self._latest[udid] = now
+        if self._timer is None:
+            self._timer = PeriodicCallback(self.flush,
+                                           self._flush_interval * 1000)
+            self._timer.start()
+        return now
+
+    def last_active(self, udid: str):
+        """ lastActivatedAt in memory, may be newer than database """
+        return self._latest.get(udid)
+
+    async def flush(self, udids: list = None):
+        """ write pending activities in one query """
+        if udids is None:
+            items, self._pending = self._pending, {}
+        else:
+            items = {u: self._pending.pop(u) for u in udids if u in self._pending} # yapf: disable
+        if not items:
+            return
+        mapping = r.expr({
+            udid: {"email": email, "at": at}
+            for udid, (email, at) in items.items()
+        })
+
+        def update_if_owned(d):
+            item = mapping[d["udid"]]
+            owned = d["using"].default(False).and_(
+                d["userId"].default(None).eq(item["email"]))
+            return r.branch(
+                owned.and_(item["at"].gt(d["lastActivatedAt"])),
+                {"lastActivatedAt": item["at"]},
+                {}) # yapf: disable
+
+        try:
+            await db.run(
+                r.table("devices").get_all(*items.keys()).update(update_if_owned)) # yapf: disable
+        except Exception:
+            for udid, item in items.items():  # retry in next flush
+                self._pending.setdefault(udid, item)
+            raise
+
+
+activity = ActivityTracker(settings.ACTIVITY_FLUSH_INTERVAL)
@@ -0,0 +1,172 @@
+# coding: utf-8
+#
+# choose the best source when a device is connected to many providers
+#
+
+import collections
+import time
+
+from tornado.ioloop import IOLoop
+
+from .changefeed import hub
+from .database import db
+
+
+class SourceStats(object):
+    def __init__(self):
+        self.rtt = None  # seconds, exponentially weighted moving average
+        self.failures = collections.deque()  # timestamps of cooldown failure
+
+
+class SourceBalancer(object):
+    """
+    score = rtt(per 100ms) * RTT_WEIGHT + sessions * SESSION_WEIGHT
+            + recent cooldown failures * FAILURE_WEIGHT
+
+    Source with the lowest score is choosen, static priority is used when
+    scores are equal. rtt and failures are kept in memory of the current
+    process. Sessions are counted from sourceId of using devices in the
+    devices changefeed, so sessions started by other processes are
+    counted too.
+
+    Sources without rtt sample are scored with the median rtt of the
+    measured sources (DEFAULT_RTT if none is measured), so a new source is
+    not always preferred to the measured ones.
+    """
+
+    RTT_WEIGHT = 1.0
+    SESSION_WEIGHT = 1.0
+    FAILURE_WEIGHT = 5.0
+    FAILURE_WINDOW = 600  # seconds
+    RTT_ALPHA = 0.3
+    DEFAULT_RTT = 0.1  # seconds
+
+    def __init__(self):
+        self._stats = collections.defaultdict(SourceStats)
+        self._sessions = collections.Counter()  # source_id -> count
+        self._session_of = {}  # udid -> source_id of using device
+        self._started = False
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        hub.subscribe(self._on_change)
+        IOLoop.current().spawn_callback(self.reload)
+
+    async def reload(self):
+        devices = await db.table("devices").filter({
+            "using": True
+        }).pluck("udid", "using", "sourceId").all()  # yapf: disable
+        for udid in list(self._session_of):
+            self._unset(udid)
+        for d in devices:
+            self._apply(d)
+
+    def _on_change(self, change: dict):
+        if change['event'] == "reset":  # changes may be lost
+            IOLoop.current().spawn_callback(self.reload)
+        elif change['event'] == "delete":
+            self._unset(change['data']['udid'])
+        else:
+            self._apply(change['data'])
+
+    def _apply(self, device: dict):
+        source_id = device.get('sourceId') if device.get('using') else None
+        if self._session_of.get(device['udid']) == source_id:
+            return
+        self._unset(device['udid'])
+        if source_id:
+            self._session_of[device['udid']] = source_id
+            self._sessions[source_id] += 1
+
+    def _unset(self, udid: str):
+        source_id = self._session_of.pop(udid, None)
+        if source_id:
+            self._sessions[source_id] -= 1
+            if not self._sessions[source_id]:
+                del self._sessions[source_id]
+
+    def observe_rtt(self, source_id: str, seconds: float):
+        stats = self._stats[source_id]
+        if stats.rtt is None:
+            stats.rtt = seconds
+        else:
+            stats.rtt += self.RTT_ALPHA * (seconds - stats.rtt)
+
+    def cooldown_failed(self, source_id: str):
+        self._stats[source_id].failures.append(time.time())
+
+    def remove(self, source_id: str):
+        self._stats.pop(source_id, None)
+
+    def default_rtt(self) -> float:
+        """ rtt of the sources not measured """
+        rtt = self._median_rtt(list(self._stats))
+        return self.DEFAULT_RTT if rtt is None else rtt
+
+    def score(self, source_id: str, default_rtt: float = None) -> float:
+        """
+        Args:
+            default_rtt: value of default_rtt(), pass it when scoring many
+                sources, so it is not calculated every time
+        """
+        if default_rtt is None:
+            default_rtt = self.default_rtt()
+        stats = self._stats.get(source_id) or SourceStats()
+        failures = stats.failures
+        while failures and failures[0] < time.time() - self.FAILURE_WINDOW:
+            failures.popleft()
+        score = self._sessions.get(source_id, 0) * self.SESSION_WEIGHT
+        score += len(failures) * self.FAILURE_WEIGHT
+        rtt = default_rtt if stats.rtt is None else stats.rtt
+        score += rtt * 10 * self.RTT_WEIGHT
+        return round(score, 2)
+
+    def scores(self) -> tuple:
+        """
+        Scores of the sources known by this process, for choosing source
+        inside a database query
+
+        Returns:
+            ({source_id: score}, score of the sources not known)
+        """
+        default_rtt = self.default_rtt()
+        source_ids = set(self._stats) | set(self._sessions)
+        scores = {i: self.score(i, default_rtt) for i in source_ids}
+        return scores, self.score(None, default_rtt)
+
+    def _median_rtt(self, source_ids: list):
+        rtts = sorted(self._stats[i].rtt for i in source_ids
+                      if i in self._stats and self._stats[i].rtt is not None)
+        if not rtts:
+            return None
+        mid = len(rtts) // 2
+        return rtts[mid] if len(rtts) % 2 else (rtts[mid - 1] + rtts[mid]) / 2
+
+    def stats(self, source_id: str) -> dict:
+        stats = self._stats.get(source_id) or SourceStats()
+        return {
+            "score": self.score(source_id),
+            "rtt": stats.rtt,
+            "sessions": self._sessions.get(source_id, 0),
+            "failures": len(stats.failures),
+        }
+
+    def choose(self, sources: list):
+        """
+        Returns:
+            (source, score) or (None, None) if sources is empty
+        """
+        best, best_key = None, None
+        default_rtt = self.default_rtt()
+        for s in sources:
+            key = (self.score(s.get('id'), default_rtt), -s.get('priority', 0))
+            if best_key is None or key < best_key:
+                best, best_key = s, key
+        if best is None:
+            return None, None
+        return best, best_key[0]
+
+
+balancer = SourceBalancer()
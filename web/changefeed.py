@@ -0,0 +1,207 @@
+# coding: utf-8
+#
+# one devices changefeed per process, shared by all websocket subscribers
+#
+
+import collections
+import uuid
+
+from logzero import logger
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from . import settings
+from .database import db
+
+
+class DeviceChangeHub(object):
+    """
+    Watch devices table once and broadcast changes to subscribers.
+
+    Every change is tagged with an increasing sequence number, and the
+    latest changes are kept in a bounded replay log. A client remembers
+    the token of the last change it received, and when reconnecting
+    only the missing changes are sent instead of the whole device list.
+
+    Token format: "<epoch>:<seq>", epoch changes when the server restarts
+    or the changefeed is reconnected, so old tokens become invalid.
+    """
+
+    def __init__(self, maxlen: int = 1000):
+        self._epoch = None
+        self._seq = 0
+        self._log = collections.deque(maxlen=maxlen)
+        self._subscribers = set()
+        self._running = False
+        self._new_epoch()
+
+    def _new_epoch(self):
+        self._epoch = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._log.clear()
+
+    @property
+    def token(self) -> str:
+        """ token of the latest change """
+        return self.make_token(self._seq)
+
+    def make_token(self, seq: int) -> str:
+        return "{}:{}".format(self._epoch, seq)
+
+    def subscribe(self, callback):
+        """
+        Args:
+            callback: function receive change dict
+                {"seq": 1, "event": "update", "data": {...}, "old": {...}}
+        """
+        self._subscribers.add(callback)
+        if not self._running:
+            self._running = True
+            IOLoop.current().spawn_callback(self._run)
+
+    def unsubscribe(self, callback):
+        self._subscribers.discard(callback)
+
+    def replay(self, token: str):
+        """
+        Returns:
+            list of changes after token, or None if token can not be resumed
+        """
+        try:
+            epoch, seq = token.split(":")
+            seq = int(seq)
+        except (AttributeError, ValueError):
+            return None
+        if epoch != self._epoch or seq > self._seq:
+            return None
+        if seq == self._seq:
+            return []
+        if not self._log or self._log[0]['seq'] > seq + 1:
+            return None  # too old, already dropped from log
+        return [c for c in self._log if c['seq'] > seq]
+
+    def _publish(self, data: dict):
+        old_val, new_val = data.get('old_val'), data.get('new_val')
+        if old_val is None and new_val is None:
+            return
+        if old_val is None:
+            event = "insert"
+        elif new_val is None:
+            event = "delete"
+        else:
+            event = "update"
+
+        self._seq += 1
+        change = {
+            "seq": self._seq,
+            "event": event,
+            "data": new_val if new_val is not None else old_val,
+            "old": old_val,
+        }
+        self._log.append(change)
+        self._broadcast(change)
+
+    def _broadcast(self, change: dict):
+        for callback in list(self._subscribers):
+            try:
+                callback(change)
+            except Exception as e:
+                logger.warning("device change callback error: %s", e)
+
+    async def _run(self):
+        while True:
+            try:
+                conn, feed = await db.table_devices.watch()
+                with conn:
+                    while await feed.fetch_next():
+                        self._publish(await feed.next())
+            except Exception as e:
+                logger.warning("device changefeed error: %s", e)
+            # changes may be lost during reconnect, tokens before is unsafe
+            self._new_epoch()
+            self._broadcast({"seq": 0, "event": "reset"})
+            await gen.sleep(1)
+
+
+_SCALARS = (str, int, float, bool, type(None))
+
+
+def _as_set(value, name: str = "filter") -> set:
+    """
+    Raises:
+        ValueError when value is not a scalar or a list of scalars
+    """
+    if value is None:
+        return None
+    values = value if isinstance(value, (list, tuple)) else [value]
+    for v in values:
+        if not isinstance(v, _SCALARS):
+            raise ValueError(name + " should be string, number or list of them") # yapf: disable
+    return set(values)
+
+
+class DeviceFilter(object):
+    """
+    Filters from client subscribe message, all conditions must match
+
+        {
+            "platform": "android",  # or list of platform
+            "owner": ["group-id", "someone@example.com"],  # alias: group
+            "udids": ["xxxx", "yyyy"],
+            "properties": {"brand": "HUAWEI", "version": ["8.0.0", "9"]}
+        }
+
+    Raises:
+        ValueError when filters is invalid
+    """
+
+    def __init__(self, filters: dict = None):
+        filters = filters or {}
+        if not isinstance(filters, dict):
+            raise ValueError("filters should be object")
+        unknown = set(filters) - {"platform", "owner", "group", "udids", "properties"} # yapf: disable
+        if unknown:
+            raise ValueError("unknown filter: " + ", ".join(sorted(unknown)))
+
+        self.platforms = _as_set(filters.get("platform"), "platform")
+        self.owners = _as_set(filters.get("owner"), "owner")
+        groups = _as_set(filters.get("group"), "group")
+        if groups is not None:
+            self.owners = (self.owners or set()) | groups
+        self.udids = _as_set(filters.get("udids"), "udids")
+
+        props = filters.get("properties") or {}
+        if not isinstance(props, dict):
+            raise ValueError("properties filter should be object")
+        self.properties = [(k, _as_set(v, "properties." + k))
+                           for k, v in props.items()]
+
+    def _key(self):
+        return (self.platforms, self.owners, self.udids,
+                sorted(self.properties, key=lambda p: p[0]))
+
+    def __eq__(self, other):
+        return isinstance(other, DeviceFilter) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def match(self, device: dict) -> bool:
+        if self.udids is not None and device.get("udid") not in self.udids:
+            return False
+        if self.platforms is not None and \
+                device.get("platform") not in self.platforms:
+            return False
+        if self.owners is not None and \
+                device.get("owner", "") not in self.owners:
+            return False
+        if self.properties:
+            props = device.get("properties") or {}
+            for key, values in self.properties:
+                value = props.get(key)
+                if not isinstance(value, _SCALARS) or value not in values:
+                    return False
+        return True
+
+
+hub = DeviceChangeHub(settings.CHANGES_REPLAY_SIZE)
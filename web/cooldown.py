@@ -0,0 +1,181 @@
+# coding: utf-8
+#
+# cooldown released devices with bounded concurrency
+#
+
+import collections
+import datetime
+import time
+
+from logzero import logger
+from rethinkdb import r
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from . import settings
+from .database import db, time_now
+
+
+class CooldownJob(object):
+    def __init__(self, udid: str, source_id: str, fn, on_failure=None):
+        self.udid = udid
+        self.source_id = source_id
+        self.fn = fn  # async function, raise error to retry
+        self.on_failure = on_failure  # async function, called after retries
+        self.attempts = 0
+        self.created_at = time.time()
+
+
+class CooldownQueue(object):
+    """
+    At most `concurrency` cooldowns are running, and at most `per_source`
+    of them belong to the same provider. Each attempt is limited by
+    `timeout` seconds, failed attempts are retried after 1, 2, 4 ... seconds.
+
+    Usage:
+        cooldown.submit(CooldownJob(udid, source_id, async_fn))
+    """
+
+    RETRY_BASE = 1.0
+    RETRY_MAX_DELAY = 60.0
+    DURATION_ALPHA = 0.2
+
+    def __init__(self,
+                 concurrency: int,
+                 per_source: int,
+                 timeout: float,
+                 retries: int):
+        self.concurrency = concurrency
+        self.per_source = per_source
+        self.timeout = timeout
+        self.retries = retries
+        self._queue = collections.deque()
+        self._queued = {}  # udid -> job, waiting or retrying
+        self._running = collections.Counter()  # source_id -> count
+        self._retrying = 0
+        self._counters = collections.Counter()
+        self._duration = None  # moving average of seconds, queued to done
+        self._max_duration = 0.0
+        self._watchdog = None
+
+    def submit(self, job: CooldownJob):
+        old = self._queued.get(job.udid)
+        if old is not None:  # device released again before cooldown
+            if old in self._queue:
+                self._queue.remove(old)
+            self._counters['dropped'] += 1
+        self._queued[job.udid] = job
+        self._queue.append(job)
+        self._pump()
+
+    def _pump(self):
+        """ start jobs while there are free workers """
+        if not self._queue:
+            return
+        skipped = []
+        while self._queue and sum(self._running.values()) < self.concurrency:
+            job = self._queue.popleft()
+            if self._running[job.source_id] >= self.per_source:
+                skipped.append(job)
+                continue
+            self._running[job.source_id] += 1
+            IOLoop.current().spawn_callback(self._run, job)
+        self._queue.extendleft(reversed(skipped))
+
+    async def _run(self, job: CooldownJob):
+        job.attempts += 1
+        error = None
+        try:
+            await gen.with_timeout(
+                datetime.timedelta(seconds=self.timeout), job.fn())
+        except gen.TimeoutError:
+            error = "timeout after %ss" % self.timeout
+            self._counters['timeouts'] += 1
+        except Exception as e:
+            error = e
+        finally:
+            self._running[job.source_id] -= 1
+            if self._running[job.source_id] <= 0:
+                del self._running[job.source_id]
+
+        if self._queued.get(job.udid) is not job:  # replaced by new job
+            pass
+        elif error is None:
+            self._done(job, "succeeded")
+        elif job.attempts <= self.retries:
+            delay = min(self.RETRY_MAX_DELAY,
+                        self.RETRY_BASE * 2**(job.attempts - 1))
+            logger.warning("device [%s] cooldown error: %s, retry in %.1fs",
+                           job.udid, error, delay)
+            self._retrying += 1
+            self._counters['retries'] += 1
+            IOLoop.current().call_later(delay, self._retry, job)
+        else:
+            logger.error("device [%s] cooldown failed: %s", job.udid, error)
+            self._done(job, "failed")
+            if job.on_failure:
+                IOLoop.current().spawn_callback(job.on_failure)
+        self._pump()
+
+    def _retry(self, job: CooldownJob):
+        self._retrying -= 1
+        if self._queued.get(job.udid) is job:
+            self._queue.append(job)
+            self._pump()
+
+    def _done(self, job: CooldownJob, result: str):
+        del self._queued[job.udid]
+        self._counters[result] += 1
+        duration = time.time() - job.created_at
+        self._max_duration = max(self._max_duration, duration)
+        if self._duration is None:
+            self._duration = duration
+        else:
+            self._duration += self.DURATION_ALPHA * (duration - self._duration)
+
+    def metrics(self) -> dict:
+        return {
+            "queued": len(self._queue),
+            "running": sum(self._running.values()),
+            "retrying": self._retrying,
+            "runningBySource": dict(self._running),
+            "succeeded": self._counters['succeeded'],
+            "failed": self._counters['failed'],
+            "timeouts": self._counters['timeouts'],
+            "retries": self._counters['retries'],
+            "dropped": self._counters['dropped'],
+            "stale": self._counters['stale'],
+            "duration": {
+                "avg": round(self._duration or 0, 3),
+                "max": round(self._max_duration, 3),
+            },
+        }
+
+    def start_watchdog(self, stale_after: float, interval: float = 60):
+        """ clear colding flag which is not cleared by provider in time """
+        if self._watchdog is None and stale_after > 0:
+            self._watchdog = PeriodicCallback(
+                lambda: self.clear_stale(stale_after), interval * 1000)
+            self._watchdog.start()
+
+    async def clear_stale(self, stale_after: float):
+        deadline = time_now() - datetime.timedelta(seconds=stale_after)
+
+        def clear_if_stale(d):
+            stale = d["colding"].default(False).and_(
+                d["coldingAt"].default(r.minval).lt(deadline))
+            return r.branch(stale, {"colding": False}, {})
+
+        ret = await db.run(
+            r.table("devices").filter({
+                "colding": True
+            }).update(clear_if_stale, return_changes=True))
+        for change in ret.get('changes', []):
+            logger.warning("device [%s] colding flag is stale, cleared",
+                           change['new_val']['udid'])
+        self._counters['stale'] += len(ret.get('changes', []))
+
+
+cooldown = CooldownQueue(settings.COOLDOWN_CONCURRENCY,
+                         settings.COOLDOWN_PER_SOURCE,
+                         settings.COOLDOWN_TIMEOUT, settings.COOLDOWN_RETRIES)
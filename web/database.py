@@ -15,6 +15,10 @@ def time_now():
     return datetime.datetime.now(r.make_timezone("+08:00"))
 
 
+def from_timestamp(ts: float):
+    return datetime.datetime.fromtimestamp(ts, r.make_timezone("+08:00"))
+
+
 class DB(object):
     __tables = {
         "devices": {
@@ -28,6 +32,28 @@ class DB(object):
         "groups": {
             "name": "groups",
         },
+        "providers": {
+            "name": "providers",
+        },
+        "provider_commands": {
+            "name": "provider_commands",
+        },
+        "nodes": {
+            "name": "nodes",
+        },
+        "reservations": {
+            "name": "reservations",
+        },
+        "usage_events": {
+            "name": "usage_events",
+        },
+        "usage_rollups": {
+            "name": "usage_rollups",
+        },
+        "packages": {
+            "name": "packages",
+            "primary_key": "md5",
+        },
     }
 
     def __init__(self, db='demo', **kwargs):
@@ -62,23 +88,38 @@ class DB(object):
 
         # reset database
         safe_run(rdb.table("users").index_create("token"))
-        safe_run(rdb.table("devices").replace(lambda q: q.without("sources")))
-
-        # reload add idle check functions
-        from .views.device import D  # must import in here
-
-        devices = safe_run(
-            rdb.table("devices").filter({
-                "using": True
-            }).pluck("udid"), show_error=True)
-
-        if devices:
-            for d in devices:
-                logger.debug("Device: %s is in using state", d['udid'])
-                D(d['udid']).release_until_idle()
+        safe_run(rdb.table("devices").index_create("userId"))
+        safe_run(rdb.table("devices").index_create(
+            "source_ids", lambda d: d["sources"].default({}).keys(), multi=True)) # yapf: disable
+        safe_run(rdb.table("reservations").index_create(
+            "udid_endAt", [r.row["udid"], r.row["endAt"]])) # yapf: disable
+        safe_run(rdb.table("reservations").index_create("endAt"))
+        safe_run(rdb.table("reservations").index_create("userId"))
+        safe_run(rdb.table("usage_rollups").index_create(
+            "period_kind_bucket",
+            [r.row["period"], r.row["kind"], r.row["bucket"]])) # yapf: disable
+        safe_run(rdb.table("packages").index_create("packageName"))
+        # sources, providers and commands of the nodes stopped are removed
+        # by registry after REGISTRY_NODE_TTL, see ProviderRegistry
 
         r.set_loop_type("tornado")
 
+    async def restore(self):
+        """
+        reload idle deadlines of using devices, called when elected as leader
+        """
+        from .activity import activity
+        from .views.device import idle_deadline, idle_scheduler  # must import in here
+
+        devices = await self.table("devices").filter({
+            "using": True
+        }).pluck("udid", "userId", "lastActivatedAt", "idleTimeout").all()
+        for d in devices:
+            logger.debug("Device: %s is in using state", d['udid'])
+            if d.get('lastActivatedAt') and d.get('idleTimeout') is not None:
+                activity.acquired(d['udid'], d.get('userId'), d['idleTimeout'])
+                idle_scheduler.schedule(d['udid'], idle_deadline(d))
+
     async def connection(self):
         """ TODO(ssx): add pool support """
         return await r.connect(db=self.__dbname, **self.__connect_kwargs)
@@ -189,10 +230,10 @@ class TableHelper(object):
     def run(self):
         return self.__db.run(self.__reql)
 
-    async def watch(self):
-        """ return (conn, feed) """
+    async def watch(self, **kwargs):
+        """ return (conn, feed), kwargs is passed to changes() """
         conn = await self.__db.connection()
-        feed = await self.__reql.changes().run(conn)
+        feed = await self.__reql.changes(**kwargs).run(conn)
         return conn, feed
 
     async def all(self):
@@ -0,0 +1,59 @@
+# coding: utf-8
+#
+# message encodings for websocket, negotiated with ?encoding=json|msgpack
+#
+
+import json
+
+from . import jsondate
+
+try:
+    import msgpack
+except ImportError:  # in requirements.txt, negotiation fails without it
+    msgpack = None
+
+
+class JSONCodec(object):
+    name = "json"
+    binary = False
+
+    @staticmethod
+    def dumps(data) -> str:
+        if isinstance(data, dict):
+            return jsondate.dumps(data)
+        return json.dumps(data)
+
+    @staticmethod
+    def loads(message):
+        return json.loads(message)
+
+
+class MsgpackCodec(object):
+    """ datetime is packed as msgpack Timestamp, and unpacked as UTC datetime """
+    name = "msgpack"
+    binary = True
+
+    @staticmethod
+    def dumps(data) -> bytes:
+        return msgpack.packb(data, use_bin_type=True, datetime=True)
+
+    @staticmethod
+    def loads(message):
+        if isinstance(message, str):  # text frame from a json client
+            return json.loads(message)
+        return msgpack.unpackb(message, raw=False, timestamp=3)
+
+
+def get_codec(name: str = None):
+    """
+    Raises:
+        ValueError when encoding is unknown or not installed
+    """
+    name = (name or "json").lower()
+    if name == "json":
+        return JSONCodec
+    if name == "msgpack":
+        if msgpack is None:
+            raise ValueError("msgpack is not installed on server")
+        return MsgpackCodec
+    raise ValueError("unknown encoding: " + name)
@@ -0,0 +1,86 @@
+# coding: utf-8
+#
+# hashed timer wheel, used to find expired keys without per key timers
+#
+
+import math
+
+
+class TimerWheel(object):
+    """
+    Keys are put into slot (deadline / tick) % len(slots).
+
+    Updating the deadline of an existing key only changes a dict, the key
+    stays in the old slot, and is moved to the right slot when the old
+    slot is visited. So refreshing thousands of keys per second is cheap.
+
+    Usage:
+        wheel = TimerWheel(tick=1.0)
+        wheel.schedule("key", time.time() + 60)
+        for key in wheel.advance(time.time()):
+            print(key, "expired")
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 512):
+        self._tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._deadlines = {}  # key -> deadline
+        self._cursor = None  # index of the next tick to visit
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def _index(self, deadline: float) -> int:
+        return int(math.ceil(deadline / self._tick))
+
+    def _put(self, key, deadline: float):
+        index = self._index(deadline)
+        if self._cursor is not None and index < self._cursor:
+            index = self._cursor
+        self._slots[index % len(self._slots)].add(key)
+
+    def schedule(self, key, deadline: float):
+        """ add key or change its deadline """
+        old = self._deadlines.get(key)
+        self._deadlines[key] = deadline
+        if old is None or deadline < old:
+            self._put(key, deadline)
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+
+    def deadline(self, key):
+        return self._deadlines.get(key)
+
+    def advance(self, now: float) -> list:
+        """
+        Returns:
+            list of keys expired before now, they are removed from wheel
+        """
+        end = int(math.floor(now / self._tick))
+        if self._cursor is None:
+            self._cursor = end
+        # no need to visit the same slot twice in one round
+        start = max(self._cursor, end - len(self._slots) + 1)
+
+        expired = []
+        for index in range(start, end + 1):
+            slot = self._slots[index % len(self._slots)]
+            if not slot:
+                continue
+            keys = list(slot)
+            slot.clear()
+            for key in keys:
+                deadline = self._deadlines.get(key)
+                if deadline is None:  # canceled
+                    continue
+                if deadline <= now:
+                    del self._deadlines[key]
+                    expired.append(key)
+                else:  # deadline extended, or in one of the next rounds
+                    self._put(key, deadline)
+        self._cursor = end + 1
+        return expired
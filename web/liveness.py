@@ -0,0 +1,100 @@
+# coding: utf-8
+#
+# last seen time of providers and devices, stale providers are evicted
+#
+
+import datetime
+import time
+
+from rethinkdb import r
+from tornado.ioloop import PeriodicCallback
+
+from . import settings
+from .libs.timerwheel import TimerWheel
+
+
+def _seen(t: float, now: float) -> dict:
+    return {
+        "lastSeenAt": datetime.datetime.fromtimestamp(t, r.make_timezone("+08:00")),
+        "heartbeatLag": round(now - t, 3),
+    }  # yapf: disable
+
+
+class LivenessTracker(object):
+    """
+    Record when providers (ping, update) and devices (update) are seen.
+
+    Deadlines of all providers are kept in one TimerWheel, checked by a
+    single periodic callback, no matter how many providers are connected.
+    """
+
+    def __init__(self, timeout: float, tick: float = 1.0):
+        self.timeout = timeout
+        self.providers = {}  # source_id -> last seen timestamp
+        self.devices = {}  # source_id -> {udid: last seen timestamp}
+        self._tick = tick
+        self._wheel = TimerWheel(tick)
+        self._timer = None
+        self._on_expire = None
+
+    def start(self, on_expire):
+        """
+        Args:
+            on_expire: function(source_id) called when provider is stale
+        """
+        self._on_expire = on_expire
+        if self._timer is None and self.timeout > 0:
+            self._timer = PeriodicCallback(self._check, self._tick * 1000)
+            self._timer.start()
+
+    def touch(self, source_id: str, udid: str = None):
+        now = time.time()
+        self.providers[source_id] = now
+        if self.timeout > 0:
+            self._wheel.schedule(source_id, now + self.timeout)
+        if udid:
+            self.devices.setdefault(source_id, {})[udid] = now
+
+    def forget_device(self, source_id: str, udid: str):
+        self.devices.get(source_id, {}).pop(udid, None)
+
+    def remove(self, source_id: str):
+        self.providers.pop(source_id, None)
+        self.devices.pop(source_id, None)
+        self._wheel.cancel(source_id)
+
+    def provider_info(self, source_id: str) -> dict:
+        """
+        Returns:
+            {"lastSeenAt": datetime, "heartbeatLag": seconds,
+             "devices": {udid: {"lastSeenAt": .., "heartbeatLag": ..}}}
+            or None if provider is unknown
+        """
+        last_seen = self.providers.get(source_id)
+        if last_seen is None:
+            return None
+        now = time.time()
+        info = _seen(last_seen, now)
+        info['devices'] = {
+            udid: _seen(t, now)
+            for udid, t in self.devices.get(source_id, {}).items()
+        }
+        return info
+
+    def device_info(self, udid: str) -> dict:
+        """ most recent seen time of device from any provider """
+        last_seen = None
+        for udids in self.devices.values():
+            t = udids.get(udid)
+            if t is not None and (last_seen is None or t > last_seen):
+                last_seen = t
+        if last_seen is None:
+            return None
+        return _seen(last_seen, time.time())
+
+    def _check(self):
+        for source_id in self._wheel.advance(time.time()):
+            self._on_expire(source_id)
+
+
+liveness = LivenessTracker(settings.PROVIDER_LIVENESS_TIMEOUT)
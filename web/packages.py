@@ -0,0 +1,72 @@
+# coding: utf-8
+#
+# parsed metadata of uploaded files, keyed by md5
+#
+
+from rethinkdb import r
+
+from .database import db, time_now
+
+# returned to clients together with url and md5sum
+INFO_FIELDS = ("packageName", "mainActivity", "versionCode", "versionName",
+               "iconPath", "permissions", "size")
+
+
+class PackageStore(object):
+    """
+    Table packages:
+
+        {"md5": "13f46364434b526b77620ebf9bcf7322", "path": "uploads/13/../file.apk",
+         "filename": "wakey.apk", "uploader": "someone@example.com",
+         "createdAt": datetime, "packageName": "com.doublep.wakey",
+         "versionCode": "24", "versionName": "3.2.3", ...}
+
+    Parsing apk is slow and the result never changes for the same content,
+    so a file uploaded again is served from this table instead.
+    """
+
+    async def get(self, md5sum: str):
+        """
+        Returns:
+            package dict or None
+        """
+        return await db.table("packages").get(md5sum).run()
+
+    async def save(self, md5sum: str, path: str, fileinfo: dict,
+                   filename: str = None, uploader: str = None) -> dict:
+        doc = {
+            "md5": md5sum,
+            "path": path.replace("\\", "/"),
+            "filename": filename,
+            "uploader": uploader,
+            "createdAt": time_now(),
+        }
+        doc.update(fileinfo)
+        # keep the first record when uploaded at the same time
+        await db.table("packages").insert(doc, conflict=lambda id, old, new: old) # yapf: disable
+        return doc
+
+    async def find(self, package_name: str, version: str = None,
+                   skip: int = 0, limit: int = 20) -> list:
+        """
+        Args:
+            version: match versionName or versionCode
+            skip: number of packages to skip, for paging
+
+        Returns:
+            packages with the newest first
+        """
+        reql = db.table("packages").get_all(package_name, index="packageName")
+        if version:
+            reql = reql.filter(
+                r.row["versionName"].eq(version).or_(
+                    r.row["versionCode"].eq(version))) # yapf: disable
+        reql = reql.order_by(r.desc("createdAt"))
+        return await reql.skip(skip).limit(limit).all()
+
+
+def fileinfo_of(package: dict) -> dict:
+    return {k: package[k] for k in INFO_FIELDS if k in package}
+
+
+packages = PackageStore()
@@ -0,0 +1,217 @@
+# coding: utf-8
+#
+# concurrent device quotas of users, groups and batch jobs
+#
+
+import collections
+
+from logzero import logger
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from . import settings
+from .changefeed import hub
+from .database import db
+
+PRIORITIES = ("interactive", "batch")
+
+
+class QuotaError(Exception):
+    """
+    Attributes:
+        reason: one of user_quota, group_quota, batch_quota
+    """
+
+    def __init__(self, description: str, reason: str = "quota"):
+        super().__init__(description)
+        self.reason = reason
+
+
+class QuotaTracker(object):
+    """
+    Count devices in use by user, by groups of the user and by priority in
+    memory, so checking quota does not need count queries. A device is
+    counted for every group the user belongs to, no matter who owns it.
+
+    Counters are built from devices table and kept up to date by the device
+    changefeed, so devices acquired by other server processes are counted
+    too. Acquiring in this process is reserved before the database update
+    (check and increment without yield, so it is atomic in the IOLoop). The
+    reservation is counted in addition to the current holder of the device,
+    which is replaced only after the database update succeeds.
+
+    Quotas are exact only with one server process (--processes 1). Acquires
+    handled by N processes at the same moment can not see the reservations
+    of each other, so a quota may be exceeded by up to N-1 devices.
+
+    Limits, 0 means unlimited:
+        user: users.quota.devices or USER_DEVICE_QUOTA
+        group: groups.quota.devices or GROUP_DEVICE_QUOTA
+        batch of group: groups.quota.batch or GROUP_BATCH_QUOTA
+        batch in total: BATCH_DEVICE_QUOTA
+    """
+
+    def __init__(self):
+        self._entries = {}  # udid -> (email, groups, priority) of using device
+        self._users = collections.Counter()
+        self._groups = collections.Counter()  # (group, priority) -> count
+        self._batch = 0
+        self._limits = {"user": {}, "group": {}}  # id -> quota dict
+        self._user_groups = {}  # email -> tuple of group ids
+        self._started = False
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        hub.subscribe(self._on_change)
+        IOLoop.current().spawn_callback(self.reload)
+        PeriodicCallback(self.reload_limits, 60 * 1000).start()
+
+    async def reload(self):
+        await self.reload_limits()  # groups of users are needed for counting
+        devices = await db.table("devices").filter({
+            "using": True
+        }).pluck("udid", "using", "userId", "priority").all()  # yapf: disable
+        for udid in list(self._entries):
+            self._unset(udid)
+        for d in devices:
+            self._apply(d)
+
+    async def reload_limits(self):
+        """ reload quotas and groups of users """
+        try:
+            users = await db.table("users").filter(
+                lambda u: u.has_fields("quota").or_(u.has_fields("groups"))
+            ).pluck("email", "quota", "groups").all()  # yapf: disable
+            groups = await db.table("groups").has_fields("quota").pluck(
+                "id", "quota").all()
+        except Exception as e:
+            logger.warning("reload quota error: %s", e)
+            return
+        self._limits = {
+            "user": {u['email']: u['quota'] for u in users if 'quota' in u},
+            "group": {g['id']: g['quota'] for g in groups},
+        }
+        self._user_groups = {
+            u['email']: tuple(sorted(u.get('groups') or {}))
+            for u in users
+        }
+
+    def _on_change(self, change: dict):
+        if change['event'] == "reset":  # changes may be lost
+            IOLoop.current().spawn_callback(self.reload)
+        elif change['event'] == "delete":
+            self._unset(change['data']['udid'])
+        else:
+            self._apply(change['data'])
+
+    def _apply(self, device: dict):
+        udid = device['udid']
+        if device.get('using') and device.get('userId'):
+            self._set(udid, device['userId'], device.get('priority'))
+        else:
+            self._unset(udid)
+
+    def _set(self, udid: str, email: str, priority: str = None):
+        entry = (email, self._user_groups.get(email, ()), priority or "interactive") # yapf: disable
+        if self._entries.get(udid) == entry:
+            return
+        self._unset(udid)
+        self._entries[udid] = entry
+        self._count(entry, 1)
+
+    def _unset(self, udid: str):
+        entry = self._entries.pop(udid, None)
+        if entry:
+            self._count(entry, -1)
+
+    def _count(self, entry, n: int):
+        email, groups, priority = entry
+        self._users[email] += n
+        for group in groups:
+            self._groups[(group, priority)] += n
+        if priority == "batch":
+            self._batch += n
+
+    def _limit(self, kind: str, id: str, name: str, default: int) -> int:
+        quota = self._limits[kind].get(id) or {}
+        return quota.get(name, default) or 0
+
+    def reserve(self, udid: str, email: str, priority: str = "interactive"):
+        """
+        Check quotas and count the device as used by email
+
+        Returns:
+            reserved entry passed to confirm or rollback, None if the
+            device is already used by email
+
+        Raises:
+            QuotaError, ValueError(unknown priority)
+        """
+        if priority not in PRIORITIES:
+            raise ValueError("priority should be one of " + ", ".join(PRIORITIES)) # yapf: disable
+        previous = self._entries.get(udid)
+        if previous and previous[0] == email:
+            return None  # already used by the same user
+        groups = self._user_groups.get(email, ())
+
+        limit = self._limit("user", email, "devices", settings.USER_DEVICE_QUOTA) # yapf: disable
+        if limit and self._users[email] >= limit:
+            raise QuotaError("user quota exceeded (%d devices)" % limit, "user_quota") # yapf: disable
+        for group in groups:
+            used = self._groups[(group, "interactive")] + self._groups[(group, "batch")] # yapf: disable
+            limit = self._limit("group", group, "devices", settings.GROUP_DEVICE_QUOTA) # yapf: disable
+            if limit and used >= limit:
+                raise QuotaError("group quota exceeded (%d devices)" % limit, "group_quota") # yapf: disable
+            limit = self._limit("group", group, "batch", settings.GROUP_BATCH_QUOTA) # yapf: disable
+            if priority == "batch" and limit and self._groups[(group, "batch")] >= limit: # yapf: disable
+                raise QuotaError("batch quota of group exceeded (%d devices)" % limit, "batch_quota") # yapf: disable
+        limit = settings.BATCH_DEVICE_QUOTA
+        if priority == "batch" and limit and self._batch >= limit:
+            raise QuotaError("batch quota exceeded (%d devices)" % limit, "batch_quota") # yapf: disable
+
+        entry = (email, groups, priority)
+        self._count(entry, 1)
+        return entry
+
+    def confirm(self, udid: str, entry: tuple = None):
+        """ database updated, the device is used by entry now """
+        if entry:
+            self._count(entry, -1)
+            self._set(udid, entry[0], entry[2])
+
+    def rollback(self, udid: str, entry: tuple = None):
+        """ database update failed, forget the reservation """
+        if entry:
+            self._count(entry, -1)
+
+    def released(self, udid: str):
+        self._unset(udid)
+
+    def stats(self) -> dict:
+        groups = collections.defaultdict(dict)
+        for (group, priority), n in self._groups.items():
+            if n:
+                groups[group][priority] = n
+        return {
+            "users": {email: n for email, n in self._users.items() if n},
+            "groups": groups,
+            "batch": self._batch,
+            "limits": self._limits,
+            "defaults": {
+                "user": settings.USER_DEVICE_QUOTA,
+                "group": settings.GROUP_DEVICE_QUOTA,
+                "groupBatch": settings.GROUP_BATCH_QUOTA,
+                "batch": settings.BATCH_DEVICE_QUOTA,
+            },
+        }
+
+    async def set_limits(self, kind: str, id: str, limits: dict):
+        """ save quota of user or group, 0 means unlimited """
+        table, key = ("users", id) if kind == "user" else ("groups", id)
+        ret = await db.table(table).get(key).update({"quota": limits})
+        await self.reload_limits()
+        return ret
+
+
+quota = QuotaTracker()
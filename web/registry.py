@@ -0,0 +1,375 @@
+# coding: utf-8
+#
+# provider registry shared by all server processes
+#
+
+import datetime
+import hashlib
+import uuid
+
+from logzero import logger
+from tornado import gen
+from rethinkdb import r
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.websocket import WebSocketClosedError
+
+from . import settings
+from .database import db, time_now
+
+
+class ProviderCallError(Exception):
+    pass
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class LocalBroker(object):
+    """ in-process stand-in, used when there is only one server process """
+
+    def __init__(self):
+        self._node_id = None
+        self._callback = None
+
+    def start(self, node_id: str, callback):
+        self._node_id = node_id
+        self._callback = callback
+
+    async def publish(self, node_id: str, message: dict) -> bool:
+        if node_id != self._node_id:
+            logger.warning("node %s is not reachable with local broker", node_id) # yapf: disable
+            return False
+        self._callback(message)
+        return True
+
+
+class RethinkBroker(object):
+    """
+    deliver messages through table provider_commands, every node watch the
+    messages send to itself, and delete them after handled
+    """
+
+    table = "provider_commands"
+
+    def __init__(self):
+        self._node_id = None
+        self._callback = None
+
+    def start(self, node_id: str, callback):
+        self._node_id = node_id
+        self._callback = callback
+        IOLoop.current().spawn_callback(self._watch)
+
+    async def publish(self, node_id: str, message: dict) -> bool:
+        ret = await db.table(self.table).insert({
+            "node": node_id,
+            "message": message,
+            "createdAt": time_now(),
+        })  # yapf: disable
+        return ret['inserted'] == 1
+
+    async def _watch(self):
+        while True:
+            try:
+                reql = db.table(self.table).filter({"node": self._node_id})
+                conn, feed = await reql.watch(include_initial=True)
+                with conn:
+                    while await feed.fetch_next():
+                        item = (await feed.next()).get('new_val')
+                        if not item:
+                            continue
+                        await db.table(self.table).get(item['id']).delete()
+                        self._callback(item['message'])
+            except Exception as e:
+                logger.warning("broker watch error: %s", e)
+            await gen.sleep(1)
+
+
+class ProviderRegistry(object):
+    """
+    Remember which node every provider is connected to, so that commands
+    can be send to the provider from any server process.
+
+    Providers connected to this process are kept in `local`
+
+    Every node writes its heartbeat into table nodes. Nodes not seen in
+    REGISTRY_NODE_TTL seconds are dead, their providers, undelivered
+    commands and device sources are removed by the leader. So a node
+    restarting does not touch the records of other nodes.
+
+    The leader is the node holding the lease row LEADER_KEY in table nodes,
+    renewed with the heartbeat and taken over by another node when it is
+    not renewed in REGISTRY_NODE_TTL seconds. Work that must be done once
+    for all the nodes is done by the leader, see `on_leader`.
+
+    Messages between nodes:
+        {"sourceId": "xxx", "data": {...}}  # write data to provider
+        {"sourceId": "xxx", "action": "takeover"}  # call actions[name]
+        {"sourceId": "xxx", "call": {...}, "callId": "xx", "replyTo": "node"}
+        {"callId": "xx", "result": {...}, "error": null}  # reply of call
+    """
+
+    brokers = {
+        "local": LocalBroker,
+        "rethinkdb": RethinkBroker,
+    }
+    LEADER_KEY = "leader"
+
+    def __init__(self):
+        self.node_id = None  # created after fork, see main.py --processes
+        self.local = {}  # source_id -> ProviderHeartbeatWSHandler
+        self.actions = {}  # name -> function(source_id)
+        self.remove_sources = None  # async function(source_id), devices cleanup
+        self._broker = None
+        self._replies = {}  # callId -> Future
+        self._heartbeat = None
+        self.leader = False
+        self.on_leader = []  # functions(leader: bool), leadership changed
+        self._orphans = None  # sources without provider record in last check
+
+    def start(self):
+        """ start heartbeat and cleanup of dead nodes, called in every process """
+        self._start()
+        if self._heartbeat is None:
+            self._heartbeat = PeriodicCallback(
+                self._beat, settings.REGISTRY_HEARTBEAT_INTERVAL * 1000)
+            self._heartbeat.start()
+            IOLoop.current().spawn_callback(self._beat)
+
+    def _start(self):
+        if self._broker is None:
+            self.node_id = uuid.uuid4().hex
+            self._broker = self.brokers[settings.REGISTRY_BROKER]()
+            self._broker.start(self.node_id, self._on_message)
+
+    async def _beat(self):
+        try:
+            await db.table("nodes").insert({
+                "id": self.node_id,
+                "heartbeatAt": time_now(),
+            }, conflict="update")  # yapf: disable
+            await self._elect()
+            if self.leader:
+                await self.remove_dead_nodes()
+        except Exception as e:
+            logger.warning("registry heartbeat error: %s", e)
+
+    async def _elect(self):
+        """ take or renew the leader lease """
+        now = time_now()
+        expires_at = now + datetime.timedelta(seconds=settings.REGISTRY_NODE_TTL) # yapf: disable
+
+        def keep_or_take(id, old, new):
+            mine = old["node"].eq(self.node_id)
+            return r.branch(mine.or_(old["expiresAt"].lt(now)), new, old)
+
+        ret = await db.table("nodes").insert({
+            "id": self.LEADER_KEY,
+            "node": self.node_id,
+            "expiresAt": expires_at,
+        }, conflict=keep_or_take)  # yapf: disable
+        leader = ret['inserted'] + ret['replaced'] > 0
+        if leader == self.leader:
+            return
+        logger.info("node %s %s leader", self.node_id,
+                    "becomes" if leader else "is no longer")
+        self.leader = leader
+        self._orphans = None  # check sources left by the last leader
+        for fn in self.on_leader:
+            try:
+                fn(leader)
+            except Exception as e:
+                logger.warning("leader callback error: %s", e)
+
+    async def remove_dead_nodes(self):
+        """ called by the leader only """
+        deadline = time_now() - datetime.timedelta(
+            seconds=settings.REGISTRY_NODE_TTL)
+        nodes = await db.table("nodes").filter(
+            r.row["heartbeatAt"].gt(deadline)).pluck("id").all()
+        alive = r.expr([n['id'] for n in nodes] + [self.node_id])
+        await db.table("nodes").filter(r.row["heartbeatAt"].le(deadline)).delete() # yapf: disable
+        await db.table("provider_commands").filter(
+            lambda c: alive.contains(c["node"]).not_()).delete()
+
+        # delete record first, provider may be resuming on a live node.
+        # sources are found by index source_ids, no need to scan devices
+        ret = await db.run(
+            r.table("providers").filter(
+                lambda p: alive.contains(p["node"]).not_()).delete(
+                    return_changes=True))
+        for change in ret.get('changes', []):
+            source_id = change['old_val']['id']
+            logger.info("provider %s is gone with node %s", source_id,
+                        change['old_val'].get('node'))
+            try:
+                await self.remove_sources(source_id)
+            except Exception as e:
+                logger.warning("remove sources of %s error: %s", source_id, e) # yapf: disable
+                self._orphans = None
+        await self.remove_orphan_sources()
+
+    async def remove_orphan_sources(self):
+        """
+        Sources left when the sweep above is interrupted, e.g. the last
+        leader crashed. Only checked after leader changed or removing
+        failed, and twice in case provider is registering.
+        """
+        if self._orphans is not None and not self._orphans:
+            return
+        source_ids = await db.run(
+            r.table("devices").distinct(index="source_ids"))
+        providers = await db.table("providers").pluck("id").all()
+        orphans = set(source_ids) - set([p['id'] for p in providers])
+        orphans -= set(self.local)
+        for source_id in orphans & (self._orphans or set()):
+            logger.info("remove sources of unknown provider %s", source_id)
+            await self.remove_sources(source_id)
+            orphans.discard(source_id)
+        self._orphans = orphans
+
+    async def register(self, source_id: str, handler, info: dict,
+                       token: str = None):
+        """
+        Args:
+            token: resume token, only the hash is saved
+        """
+        self._start()
+        self.local[source_id] = handler
+        await db.table("providers").save({
+            "node": self.node_id,
+            "name": info.get("name"),
+            "url": info.get("url"),
+            "owner": info.get("owner"),
+            "rpc": bool(info.get("rpc")),
+            "tokenHash": hash_token(token) if token else None,
+            "connectedAt": time_now(),
+        }, source_id)  # yapf: disable
+
+    def unregister(self, source_id: str, handler=None, keep_record=False):
+        """
+        remove provider only if it is still the given handler
+
+        Args:
+            keep_record: keep database record, so that provider can resume
+                from other node
+        """
+        if handler is not None and self.local.get(source_id) is not handler:
+            return
+        self.local.pop(source_id, None)
+        if not keep_record:
+            IOLoop.current().spawn_callback(self.remove_record, source_id)
+
+    async def lookup(self, source_id: str):
+        """ return provider record or None """
+        self._start()
+        return await db.table("providers").get(source_id).run()
+
+    async def takeover(self, source_id: str, node_id: str) -> bool:
+        """ tell node the provider is resumed somewhere else """
+        return await self._broker.publish(node_id, {
+            "sourceId": source_id,
+            "action": "takeover",
+        })  # yapf: disable
+
+    async def remove_record(self, source_id: str):
+        if source_id in self.local:  # already reconnected
+            return
+        # provider may have reconnected to another node
+        await db.table("providers").get_all(source_id).filter({
+            "node": self.node_id
+        }).delete()  # yapf: disable
+
+    async def send(self, source_id: str, data: dict) -> bool:
+        """
+        Returns:
+            bool: if message is delivered to the node of provider
+        """
+        self._start()
+        ws = self.local.get(source_id)
+        if ws:
+            await ws.write_data(data)
+            return True
+        record = await db.table("providers").get(source_id).run()
+        if not record or record.get('node') == self.node_id:
+            return False
+        return await self._broker.publish(record['node'], {
+            "sourceId": source_id,
+            "data": data,
+        })  # yapf: disable
+
+    async def call(self, source_id: str, data: dict, timeout: float = None):
+        """
+        Send command to provider and wait for its response
+
+        Raises:
+            ProviderCallError
+        """
+        self._start()
+        ws = self.local.get(source_id)
+        if ws:
+            return await ws.call(data, timeout)
+
+        record = await db.table("providers").get(source_id).run()
+        if not record or record.get('node') == self.node_id:
+            raise ProviderCallError("provider is offline")
+        call_id = uuid.uuid4().hex
+        future = self._replies[call_id] = Future()
+        try:
+            published = await self._broker.publish(record['node'], {
+                "sourceId": source_id,
+                "call": data,
+                "timeout": timeout,
+                "callId": call_id,
+                "replyTo": self.node_id,
+            })  # yapf: disable
+            if not published:
+                raise ProviderCallError("node of provider is not reachable")
+            timeout = (timeout or settings.PROVIDER_RPC_TIMEOUT) + 5
+            reply = await gen.with_timeout(
+                datetime.timedelta(seconds=timeout), future)
+        except gen.TimeoutError:
+            raise ProviderCallError("no reply from node " + record['node'])
+        finally:
+            self._replies.pop(call_id, None)
+        if reply.get('error'):
+            raise ProviderCallError(reply['error'])
+        return reply['result']
+
+    async def _serve_call(self, message: dict):
+        reply = {"callId": message['callId'], "result": None, "error": None}
+        try:
+            reply['result'] = await self.call(message['sourceId'],
+                                              message['call'],
+                                              message.get('timeout'))
+        except ProviderCallError as e:
+            reply['error'] = str(e) or "call failed"
+        await self._broker.publish(message['replyTo'], reply)
+
+    def _on_message(self, message: dict):
+        if message.get('call'):
+            IOLoop.current().spawn_callback(self._serve_call, message)
+            return
+        if message.get('callId'):
+            future = self._replies.get(message['callId'])
+            if future and not future.done():
+                future.set_result(message)
+            return
+        if message.get('action'):
+            fn = self.actions.get(message['action'])
+            if fn:
+                fn(message.get('sourceId'))
+            return
+        ws = self.local.get(message.get('sourceId'))
+        if not ws:
+            logger.info("provider %s is not here anymore", message.get('sourceId')) # yapf: disable
+            return
+        try:
+            ws.write_data(message['data'])
+        except WebSocketClosedError:
+            logger.info("provider %s closed", message.get('sourceId'))
+
+
+registry = ProviderRegistry()
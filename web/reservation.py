@@ -0,0 +1,297 @@
+# coding: utf-8
+#
+# book devices for a time window
+#
+
+import datetime
+import time
+
+from logzero import logger
+from rethinkdb import r
+
+from . import settings
+from .changefeed import DeviceFilter
+from .database import db, from_timestamp, time_now
+from .scheduler import DeadlineScheduler
+
+_PENDING = ["booked", "active"]  # reservations which still hold the slot
+
+
+class ReservationError(Exception):
+    """
+    Attributes:
+        reason: one of invalid, not_exist, not_owner, conflict, no_device
+    """
+
+    def __init__(self, description: str, reason: str = "unknown"):
+        super().__init__(description)
+        self.reason = reason
+
+
+def reserved_by_others(d, email: str, now: datetime.datetime):
+    """
+    ReQL expression used in the acquire update of device d, true if another
+    user has a reservation which is active or starts in RESERVATION_GUARD
+    """
+    guard_at = now + datetime.timedelta(seconds=settings.RESERVATION_GUARD)
+    return d["reservations"].default([]).filter(
+        lambda x: x["userId"].ne(email).and_(x["startAt"].lt(guard_at)).and_(
+            x["endAt"].gt(now))).count().gt(0) # yapf: disable
+
+
+class ReservationBook(object):
+    """
+    Reservation: {id, udid, userId, startAt, endAt, status, createdAt}
+    status: booked -> active (device handed to user) -> finished
+            booked -> expired, canceled
+
+    Overlapping reservations of a device are found by index [udid, endAt],
+    only reservations not ended yet are scanned. Pending reservations are
+    also copied into field "reservations" of the device, so that acquire
+    checks them in the same conditional update.
+
+    When a reservation starts, device is acquired for the user. If the
+    device is used by someone else, it is released (and colding), acquiring
+    is retried every `retry_interval` seconds until the reservation ends.
+    When it ends, device is released if the user still holds it.
+    """
+
+    def __init__(self, guard: float, retry_interval: float,
+                 max_duration: float):
+        self.guard = guard
+        self.retry_interval = retry_interval
+        self.max_duration = max_duration
+        self.scheduler = DeadlineScheduler(self.start)
+        self.end_scheduler = DeadlineScheduler(self.finish)
+
+    async def conflicts(self, udid: str, start: datetime.datetime,
+                        end: datetime.datetime) -> list:
+        """ pending reservations of device overlap with [start, end) """
+        return await db.table("reservations").between(
+            [udid, start], [udid, r.maxval],
+            index="udid_endAt",
+            left_bound="open").filter(lambda x: x["startAt"].lt(end).and_(
+                r.expr(_PENDING).contains(x["status"]))).all()  # yapf: disable
+
+    async def book(self,
+                   email: str,
+                   start: float,
+                   end: float,
+                   udid: str = None,
+                   filters: dict = None,
+                   owners: list = None) -> dict:
+        """
+        Book device udid, or any device matches filters
+
+        Args:
+            start, end: timestamp in seconds
+            owners: accessible device owners, None means all devices
+
+        Raises:
+            ReservationError
+        """
+        if not (isinstance(start, (int, float)) and isinstance(end, (int, float))): # yapf: disable
+            raise ReservationError("startAt and endAt should be timestamp", "invalid") # yapf: disable
+        if start >= end or end <= time.time():
+            raise ReservationError("invalid time range", "invalid")
+        if self.max_duration and end - start > self.max_duration:
+            raise ReservationError(
+                "reservation can not be longer than %d seconds" %
+                self.max_duration, "invalid")
+        try:
+            device_filter = DeviceFilter(filters)
+        except ValueError as e:
+            raise ReservationError(str(e), "invalid")
+
+        reql = db.table("devices")
+        if udid:
+            reql = reql.get_all(udid)
+        devices = await reql.pluck("udid", "platform", "owner", "properties",
+                                   "using").all()
+        devices = [
+            d for d in devices if device_filter.match(d) and (
+                owners is None or d.get("owner", "") in owners)
+        ]
+        if not devices:
+            raise ReservationError("device not exist", "not_exist")
+        devices.sort(key=lambda d: bool(d.get('using')))  # idle devices first
+
+        start_at, end_at = from_timestamp(start), from_timestamp(end)
+        for d in devices:
+            if await self.conflicts(d['udid'], start_at, end_at):
+                continue
+            rsv = await self._insert(email, d['udid'], start_at, end_at)
+            if rsv:
+                return rsv
+        if udid:
+            raise ReservationError("device is reserved in this time range", "conflict") # yapf: disable
+        raise ReservationError("no device available in this time range", "no_device") # yapf: disable
+
+    async def _insert(self, email, udid, start_at, end_at):
+        """
+        Insert first, then check again. When two reservations are booked at
+        the same time, the one created later is deleted.
+        """
+        rsv = {
+            "udid": udid,
+            "userId": email,
+            "startAt": start_at,
+            "endAt": end_at,
+            "status": "booked",
+            "createdAt": time_now(),
+        }
+        ret = await db.table("reservations").insert(rsv)
+        rsv['id'] = ret['generated_keys'][0]
+
+        def order(x):
+            return (x['createdAt'], x['id'])
+
+        for other in await self.conflicts(udid, start_at, end_at):
+            if other['id'] != rsv['id'] and order(other) < order(rsv):
+                await db.table("reservations").get(rsv['id']).delete()
+                return None
+
+        await self._mark_device(rsv)
+        self.scheduler.schedule(rsv['id'], start_at.timestamp())
+        return rsv
+
+    async def _mark_device(self, rsv: dict):
+        """ copy reservation into device, replace the old copy if exists """
+        now = time_now()
+        item = {k: rsv[k] for k in ("id", "userId", "startAt", "endAt")}
+
+        def add(d):
+            kept = d["reservations"].default([]).filter(
+                lambda x: x["id"].ne(rsv['id']).and_(x["endAt"].gt(now)))
+            return {"reservations": kept.append(item)}
+
+        await db.table("devices").get(rsv['udid']).update(add)
+
+    async def _unmark_device(self, rsv: dict):
+        def remove(d):
+            return {
+                "reservations": d["reservations"].default([]).filter(
+                    lambda x: x["id"].ne(rsv['id']))
+            }
+
+        await db.table("devices").get(rsv['udid']).update(remove)
+
+    async def cancel(self, id: str, email: str = None):
+        """
+        Args:
+            email: owner of reservation, None for admin
+
+        Raises:
+            ReservationError
+        """
+
+        def check_and_set(x):
+            owned = r.expr(not email).or_(x["userId"].eq(email))
+            return r.branch(
+                owned.not_(), r.error("not_owner"),
+                r.expr(_PENDING).contains(x["status"]).not_(), {},
+                {"status": "canceled"}) # yapf: disable
+
+        ret = await db.run(
+            r.table("reservations").get(id).update(check_and_set,
+                                                   return_changes=True))
+        if ret['errors']:
+            raise ReservationError("reservation is not owned by you", "not_owner") # yapf: disable
+        if ret['skipped']:
+            raise ReservationError("reservation not exist", "not_exist")
+        self.scheduler.cancel(id)
+        self.end_scheduler.cancel(id)
+        for change in ret.get('changes', []):
+            await self._unmark_device(change['new_val'])
+
+    async def start(self, ids: list):
+        """ hand devices to users whose reservation starts """
+        from .views.device import AcquireError, D  # must import in here
+
+        reservations = await db.table("reservations").get_all(*ids).filter({
+            "status": "booked"
+        }).all()
+        for rsv in reservations:
+            left = rsv['endAt'].timestamp() - time.time()
+            if left <= 0:
+                await self._set_status(rsv, "expired")
+                continue
+            device = D(rsv['udid'])
+            try:
+                await device.acquire(rsv['userId'], int(left))
+            except AcquireError as e:
+                if e.reason == "not_exist":
+                    await self._set_status(rsv, "expired")
+                    continue
+                if e.reason == "busy":
+                    await self._preempt(rsv)
+                # absent or colding, try again later
+                self.scheduler.schedule(rsv['id'],
+                                        time.time() + self.retry_interval)
+                continue
+            logger.info("Device: %s is handed to %s by reservation",
+                        rsv['udid'], rsv['userId'])
+            await self._set_status(rsv, "active")
+            self.end_scheduler.schedule(rsv['id'], rsv['endAt'].timestamp())
+
+    async def finish(self, ids: list):
+        """ release devices whose reservation ends """
+        from .views.device import D, ReleaseError  # must import in here
+
+        reservations = await db.table("reservations").get_all(*ids).filter({
+            "status": "active"
+        }).all()
+        for rsv in reservations:
+            try:
+                # not released if the device is used by others already
+                await D(rsv['udid']).release(rsv['userId'])
+                logger.info("Device: %s is released for reservation end",
+                            rsv['udid'])
+            except ReleaseError as e:
+                logger.debug("release device at reservation end: %s", e)
+            await self._set_status(rsv, "finished")
+
+    async def _preempt(self, rsv: dict):
+        from .views.device import D, ReleaseError  # must import in here
+
+        device = await db.table("devices").get(rsv['udid']).run()
+        user = device and device.get('userId')
+        if not user or user == rsv['userId']:
+            return
+        logger.info("Device: %s is released from %s for reservation",
+                    rsv['udid'], user)
+        try:
+            await D(rsv['udid']).release(user)
+        except ReleaseError as e:
+            logger.warning("release reserved device error: %s", e)
+
+    async def _set_status(self, rsv: dict, status: str):
+        await db.table("reservations").get(rsv['id']).update({
+            "status": status
+        })  # yapf: disable
+        if status not in _PENDING:
+            await self._unmark_device(rsv)
+
+    async def restore(self):
+        """ reload pending reservations, must be called in only one process """
+        reservations = await db.table("reservations").between(
+            time_now(), r.maxval, index="endAt").filter(
+                lambda x: r.expr(_PENDING).contains(x["status"])).all() # yapf: disable
+        for rsv in reservations:
+            await self._mark_device(rsv)  # saved before devices keep a copy
+            if rsv['status'] == "booked":
+                self.scheduler.schedule(rsv['id'], rsv['startAt'].timestamp())
+            else:
+                self.end_scheduler.schedule(rsv['id'], rsv['endAt'].timestamp()) # yapf: disable
+        # active reservations ended while server is down
+        ended = await db.table("reservations").between(
+            r.minval, time_now(), index="endAt").filter({
+                "status": "active"
+            }).pluck("id").all()  # yapf: disable
+        if ended:
+            await self.finish([rsv['id'] for rsv in ended])
+
+
+reservations = ReservationBook(settings.RESERVATION_GUARD,
+                               settings.RESERVATION_RETRY_INTERVAL,
+                               settings.RESERVATION_MAX_DURATION)
@@ -0,0 +1,264 @@
+# coding: utf-8
+#
+# resumable chunked uploads, chunks may arrive in any order
+#
+
+import contextlib
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # windows, only the finalized marker is checked
+    fcntl = None
+
+from logzero import logger
+from tornado.concurrent import run_on_executor
+from tornado.ioloop import PeriodicCallback
+
+from . import settings
+
+_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+_MD5_RE = re.compile(r"^[0-9a-fA-F]{32}$")
+
+
+class UploadSessionError(Exception):
+    """
+    Attributes:
+        reason: one of not_exist, not_owner, invalid, incomplete, md5_mismatch,
+            finalized
+    """
+
+    def __init__(self, description: str, reason: str = "invalid"):
+        super().__init__(description)
+        self.reason = reason
+
+
+def merge_ranges(ranges: list) -> list:
+    """ [[0, 10], [10, 20], [30, 40]] -> [[0, 20], [30, 40]] """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class _Hasher(object):
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.offset = 0  # bytes hashed from the beginning
+        self.lock = threading.Lock()
+
+
+class UploadSessionStore(object):
+    """
+    Every session is a directory:
+
+        meta.json  {"id", "filename", "size", "md5", "owner", "createdAt"}
+        data       file of the final size, chunks are written at their offset
+        chunks/    empty file "<start>-<end>" for each received chunk
+        lock       flock()ed shared by writes, exclusive by finalize
+        finalized  created by finalize, writes are rejected after it
+
+    Chunk markers are created after data is written, so received ranges
+    survive server restarts and are shared by all server processes. Writing
+    the same chunk twice is harmless.
+
+    MD5 is updated in the background as soon as the data from offset 0
+    is contiguous, finalize only hashes what is left. Sessions not updated
+    for `ttl` seconds are removed by gc().
+    """
+
+    executor = ThreadPoolExecutor(4)
+
+    def __init__(self, root: str, ttl: float):
+        self.root = root
+        self.ttl = ttl
+        self._hashers = {}  # id -> _Hasher, only in this process
+        self._timer = None
+
+    def _path(self, id: str, *names) -> str:
+        if not _ID_RE.match(id or ""):
+            raise UploadSessionError("upload session not exist", "not_exist")
+        return os.path.join(self.root, id, *names)
+
+    @run_on_executor
+    def create(self, filename: str, size: int, owner: str,
+               md5: str = None) -> dict:
+        if not isinstance(size, int) or size <= 0 or size > settings.UPLOAD_MAX_SIZE: # yapf: disable
+            raise UploadSessionError("invalid size", "invalid")
+        if md5 is not None and not (isinstance(md5, str) and _MD5_RE.match(md5)): # yapf: disable
+            raise UploadSessionError("md5 should be 32 hex characters", "invalid") # yapf: disable
+        meta = {
+            "id": uuid.uuid4().hex,
+            "filename": os.path.basename(filename or "file"),
+            "size": size,
+            "md5": md5.lower() if md5 else None,
+            "owner": owner,
+            "createdAt": time.time(),
+        }
+        os.makedirs(self._path(meta['id'], "chunks"))
+        with open(self._path(meta['id'], "data"), "wb") as f:
+            f.truncate(size)  # sparse file on most file systems
+        with open(self._path(meta['id'], "meta.json"), "w") as f:
+            json.dump(meta, f)
+        return meta
+
+    def _meta(self, id: str, owner: str = None) -> dict:
+        """
+        Args:
+            owner: None means anyone (admin)
+        """
+        try:
+            with open(self._path(id, "meta.json")) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            raise UploadSessionError("upload session not exist", "not_exist")
+        if owner is not None and meta['owner'] != owner:
+            raise UploadSessionError("upload session is not owned by you", "not_owner") # yapf: disable
+        return meta
+
+    @contextlib.contextmanager
+    def _locked(self, id: str, exclusive: bool):
+        """ file lock of session, works across server processes """
+        try:
+            f = open(self._path(id, "lock"), "a")
+        except (IOError, OSError):
+            raise UploadSessionError("upload session not exist", "not_exist")
+        with f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def _check_not_finalized(self, id: str):
+        if os.path.exists(self._path(id, "finalized")):
+            raise UploadSessionError("upload session is finalized", "finalized") # yapf: disable
+
+    def _ranges(self, id: str) -> list:
+        ranges = []
+        for name in os.listdir(self._path(id, "chunks")):
+            start, end = name.split("-")
+            ranges.append([int(start), int(end)])
+        return merge_ranges(ranges)
+
+    def _status(self, id: str, meta: dict) -> dict:
+        ranges = self._ranges(id)
+        offset = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+        return {
+            "id": id,
+            "filename": meta['filename'],
+            "size": meta['size'],
+            "offset": offset,  # all data before offset is received
+            "received": sum(end - start for start, end in ranges),
+            "ranges": ranges,
+        }
+
+    @run_on_executor
+    def status(self, id: str, owner: str = None) -> dict:
+        """
+        Returns:
+            {"id", "filename", "size", "offset", "received", "ranges"}
+        """
+        return self._status(id, self._meta(id, owner))
+
+    @run_on_executor
+    def write(self, id: str, offset: int, data: bytes,
+              owner: str = None) -> dict:
+        meta = self._meta(id, owner)
+        end = offset + len(data)
+        if offset < 0 or not data or end > meta['size']:
+            raise UploadSessionError("chunk out of range", "invalid")
+        with self._locked(id, exclusive=False):
+            self._check_not_finalized(id)
+            with open(self._path(id, "data"), "r+b") as f:
+                f.seek(offset)
+                f.write(data)
+            open(self._path(id, "chunks", "%d-%d" % (offset, end)), "w").close() # yapf: disable
+        os.utime(self._path(id))  # keep session alive
+        self._hash(id, meta)
+        return self._status(id, meta)
+
+    def _hash(self, id: str, meta: dict) -> _Hasher:
+        """ hash contiguous data which is not hashed yet """
+        hasher = self._hashers.setdefault(id, _Hasher())
+        with hasher.lock:
+            ranges = self._ranges(id)
+            end = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+            if hasher.offset < end:
+                with open(self._path(id, "data"), "rb") as f:
+                    f.seek(hasher.offset)
+                    left = end - hasher.offset
+                    while left > 0:
+                        buf = f.read(min(left, 1 << 20))
+                        if not buf:
+                            break
+                        hasher.md5.update(buf)
+                        left -= len(buf)
+                hasher.offset = end
+        return hasher
+
+    @run_on_executor
+    def finalize(self, id: str, owner: str = None) -> tuple:
+        """
+        Wait for writes in progress, check the data, then reject all writes
+        and finalize later, so the data file is moved only once
+
+        Returns:
+            (meta, md5sum, path of data file)
+
+        Raises:
+            UploadSessionError
+        """
+        meta = self._meta(id, owner)
+        with self._locked(id, exclusive=True):
+            self._check_not_finalized(id)
+            hasher = self._hash(id, meta)
+            if hasher.offset < meta['size']:
+                raise UploadSessionError(
+                    "upload incomplete, %d of %d bytes received from the beginning"
+                    % (hasher.offset, meta['size']), "incomplete")
+            md5sum = hasher.md5.hexdigest()
+            if meta['md5'] and meta['md5'] != md5sum:
+                raise UploadSessionError("md5 mismatch, got " + md5sum, "md5_mismatch") # yapf: disable
+            open(self._path(id, "finalized"), "w").close()
+        return meta, md5sum, self._path(id, "data")
+
+    @run_on_executor
+    def remove(self, id: str, owner: str = None):
+        self._meta(id, owner)
+        self._hashers.pop(id, None)
+        shutil.rmtree(self._path(id), ignore_errors=True)
+
+    @run_on_executor
+    def gc(self):
+        """ remove sessions not updated in ttl seconds """
+        if not os.path.isdir(self.root):
+            return
+        deadline = time.time() - self.ttl
+        for id in os.listdir(self.root):
+            path = os.path.join(self.root, id)
+            try:
+                if os.path.getmtime(path) < deadline:
+                    logger.info("remove abandoned upload session %s", id)
+                    self._hashers.pop(id, None)
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+    def start_gc(self, interval: float = 600):
+        if self._timer is None:
+            self._timer = PeriodicCallback(self.gc, interval * 1000)
+            self._timer.start()
+
+
+sessions = UploadSessionStore(settings.UPLOAD_SESSION_DIR,
+                              settings.UPLOAD_SESSION_TTL)
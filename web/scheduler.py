@@ -0,0 +1,108 @@
+# coding: utf-8
+#
+# many deadlines, one timer
+#
+
+import heapq
+import time
+
+from logzero import logger
+from tornado.ioloop import IOLoop
+
+
+class DeadlineScheduler(object):
+    """
+    Keep deadlines in a min-heap, only one IOLoop timeout is registered for
+    the earliest one. Expired keys are passed to on_expire in batches.
+
+    Changing the deadline of a key pushes a new heap entry, the old entry
+    is dropped when it is popped (lazy deletion).
+
+    Usage:
+        async def on_expire(keys: list):
+            ...
+        scheduler = DeadlineScheduler(on_expire)
+        scheduler.schedule("udid", time.time() + 600)
+    """
+
+    def __init__(self, on_expire, batch_size: int = 100):
+        self._on_expire = on_expire
+        self._batch_size = batch_size
+        self._heap = []  # (deadline, key)
+        self._deadlines = {}  # key -> deadline
+        self._timeout = None
+        self._timeout_at = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def deadline(self, key):
+        return self._deadlines.get(key)
+
+    def schedule(self, key, deadline: float):
+        """ add key or change its deadline (timestamp in seconds) """
+        if self._deadlines.get(key) == deadline:
+            return
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        self._arm()
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+
+    def clear(self):
+        """ cancel all the deadlines """
+        self._deadlines.clear()
+        self._heap = []
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _peek(self):
+        """ earliest valid deadline, stale entries are dropped """
+        while self._heap:
+            deadline, key = self._heap[0]
+            if self._deadlines.get(key) == deadline:
+                return deadline
+            heapq.heappop(self._heap)
+        return None
+
+    def _arm(self):
+        deadline = self._peek()
+        if deadline is None:
+            return
+        if self._timeout is not None:
+            if self._timeout_at <= deadline:
+                return
+            IOLoop.current().remove_timeout(self._timeout)
+        self._timeout_at = deadline
+        self._timeout = IOLoop.current().call_later(
+            max(0, deadline - time.time()), self._fire)
+
+    def _pop_expired(self, now: float) -> list:
+        keys = []
+        while len(keys) < self._batch_size:
+            deadline = self._peek()
+            if deadline is None or deadline > now:
+                break
+            _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            keys.append(key)
+        return keys
+
+    async def _fire(self):
+        self._timeout = None
+        try:
+            while True:
+                keys = self._pop_expired(time.time())
+                if not keys:
+                    break
+                try:
+                    await self._on_expire(keys)
+                except Exception as e:
+                    logger.warning("deadline scheduler error: %s", e)
+        finally:
+            self._arm()
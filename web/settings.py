@@ -20,3 +20,71 @@ GITHUB = {
     "client_secret": "client-secret",
     "redirect_uri": "http://your-web-site/login"
 }
+
+# number of device changes kept for websocket resume
+CHANGES_REPLAY_SIZE = int(os.getenv("CHANGES_REPLAY_SIZE") or "1000")
+
+# permessage-deflate level for devicechanges websocket, 0 to disable
+WS_COMPRESSION_LEVEL = int(os.getenv("WS_COMPRESSION_LEVEL") or "6")
+
+# seconds to keep devices of a disconnected provider, waiting it to reconnect
+PROVIDER_GRACE_PERIOD = int(os.getenv("PROVIDER_GRACE_PERIOD") or "30")
+
+# how to send commands to providers connected to other server process
+# local: single process, rethinkdb: through table provider_commands
+REGISTRY_BROKER = os.getenv("REGISTRY_BROKER") or "local"
+
+# every server process writes a heartbeat, providers of processes not seen
+# in REGISTRY_NODE_TTL seconds are removed together with their devices
+REGISTRY_HEARTBEAT_INTERVAL = int(os.getenv("REGISTRY_HEARTBEAT_INTERVAL") or "10") # yapf: disable
+REGISTRY_NODE_TTL = int(os.getenv("REGISTRY_NODE_TTL") or "30")
+
+# seconds without any message before provider is considered dead, 0 to disable
+PROVIDER_LIVENESS_TIMEOUT = int(os.getenv("PROVIDER_LIVENESS_TIMEOUT") or "60")
+
+# request/response commands send to provider through websocket
+PROVIDER_RPC_TIMEOUT = int(os.getenv("PROVIDER_RPC_TIMEOUT") or "30")
+PROVIDER_RPC_CONCURRENCY = int(os.getenv("PROVIDER_RPC_CONCURRENCY") or "8")
+
+# seconds between batched writes of device lastActivatedAt
+ACTIVITY_FLUSH_INTERVAL = int(os.getenv("ACTIVITY_FLUSH_INTERVAL") or "5")
+
+# cooldown of released devices, at most CONCURRENCY in total and PER_SOURCE
+# for each provider, each attempt is limited by TIMEOUT seconds
+COOLDOWN_CONCURRENCY = int(os.getenv("COOLDOWN_CONCURRENCY") or "32")
+COOLDOWN_PER_SOURCE = int(os.getenv("COOLDOWN_PER_SOURCE") or "4")
+COOLDOWN_TIMEOUT = int(os.getenv("COOLDOWN_TIMEOUT") or "30")
+COOLDOWN_RETRIES = int(os.getenv("COOLDOWN_RETRIES") or "3")
+# seconds before colding flag not cleared by provider is reset, 0 to disable
+COOLDOWN_STALE_AFTER = int(os.getenv("COOLDOWN_STALE_AFTER") or "600")
+
+# device can not be acquired by others RESERVATION_GUARD seconds before a
+# reservation starts, handing over is retried every RETRY_INTERVAL seconds
+RESERVATION_GUARD = int(os.getenv("RESERVATION_GUARD") or "300")
+RESERVATION_RETRY_INTERVAL = int(os.getenv("RESERVATION_RETRY_INTERVAL") or "5") # yapf: disable
+# longest reservation in seconds, 0 means unlimited
+RESERVATION_MAX_DURATION = int(os.getenv("RESERVATION_MAX_DURATION") or "86400") # yapf: disable
+
+# seconds between batched writes of usage events and rollups
+USAGE_FLUSH_INTERVAL = int(os.getenv("USAGE_FLUSH_INTERVAL") or "10")
+
+# devices held by websocket are released LEASE_GRACE_PERIOD seconds after
+# disconnected, ping is sent every LEASE_PING_INTERVAL seconds (0 to disable)
+LEASE_GRACE_PERIOD = int(os.getenv("LEASE_GRACE_PERIOD") or "30")
+LEASE_PING_INTERVAL = int(os.getenv("LEASE_PING_INTERVAL") or "20")
+
+# concurrent devices, 0 means unlimited, can be overwritten by quota of user
+# or group in database. devices are counted for every group of the user.
+# only exact with one server process, see QuotaTracker
+USER_DEVICE_QUOTA = int(os.getenv("USER_DEVICE_QUOTA") or "0")
+GROUP_DEVICE_QUOTA = int(os.getenv("GROUP_DEVICE_QUOTA") or "0")
+GROUP_BATCH_QUOTA = int(os.getenv("GROUP_BATCH_QUOTA") or "0")
+# devices acquired with priority batch by all users
+BATCH_DEVICE_QUOTA = int(os.getenv("BATCH_DEVICE_QUOTA") or "0")
+
+# resumable uploads, sessions not updated in UPLOAD_SESSION_TTL seconds are removed
+UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE") or str(8 << 30))
+UPLOAD_SESSION_DIR = os.getenv("UPLOAD_SESSION_DIR") or "upload_sessions"
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL") or "86400")
+# chunks are buffered in memory, must be smaller than max_body_size of server(100M)
+UPLOAD_CHUNK_MAX_SIZE = int(os.getenv("UPLOAD_CHUNK_MAX_SIZE") or str(32 << 20)) # yapf: disable
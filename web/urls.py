@@ -5,15 +5,28 @@ import os
 
 from .views import LogoutHandler, MainHandler
 from .views.base import make_redirect_handler
-from .views.device import (AndroidDeviceControlHandler, APIDeviceHandler,
-                           APIDeviceListHandler, APIDevicePropertiesHandler,
+from .views.device import (AndroidDeviceControlHandler, APICooldownHandler,
+                           APIDeviceHandler, APIDeviceListHandler,
+                           APIDevicePropertiesHandler,
                            APIUserDeviceActiveHandler, APIUserDeviceHandler,
-                           AppleDeviceListHandler, DeviceChangesWSHandler,
+                           APIUserDevicesActiveHandler,
+                           AppleDeviceListHandler, DeviceBookWSHandler,
+                           DeviceChangesWSHandler,
                            DeviceItemHandler, DeviceListHandler)
 from .views.group import (APIGroupUserListHandler, APIUserGroupListHandler,
                           UserGroupCreateHandler)
-from .views.provider import ProviderHeartbeatWSHandler
-from .views.upload import UploadItemHandler, UploadListHandler
+from .views.package import APIPackageHandler, APIPackageListHandler
+from .views.provider import APIProviderListHandler, ProviderHeartbeatWSHandler
+from .views.quota import APIQuotaHandler
+from .views.reservation import (APIDeviceReservationListHandler,
+                                APIUserReservationHandler,
+                                APIUserReservationListHandler)
+from .views.upload import (APIUploadCheckHandler,
+                           APIUploadSessionFinalizeHandler,
+                           APIUploadSessionHandler,
+                           APIUploadSessionListHandler, UploadItemHandler,
+                           UploadListHandler)
+from .views.usage import APIUsageHandler
 from .views.user import (
     AdminListHandler, APIAdminListHandler, APIUserHandler,
     APIUserSettingsHandler, UserHandler)
@@ -35,18 +48,34 @@ urlpatterns = [
 
     (r"/websocket/devicechanges", DeviceChangesWSHandler),
     (r"/websocket/heartbeat", ProviderHeartbeatWSHandler),
+    (r"/websocket/devices/book", DeviceBookWSHandler),
+    (r"/websocket/devices/([^/]+)/book", DeviceBookWSHandler),
     # For compability of atx-server-1
     (r"/list", make_redirect_handler("/api/v1/devices")),
     # RESP API
     (r"/api/v1/devices", APIDeviceListHandler), # GET
     (r"/api/v1/devices/([^/]+)", APIDeviceHandler), # GET
     (r"/api/v1/devices/([^/]+)/properties", APIDevicePropertiesHandler), # GET, PUT
+    (r"/api/v1/devices/([^/]+)/reservations", APIDeviceReservationListHandler), # GET
     (r"/api/v1/user", APIUserHandler), # GET
     (r"/api/v1/user/devices", APIUserDeviceHandler), # GET, POST, DELETE
+    (r"/api/v1/user/devices/active", APIUserDevicesActiveHandler), # GET
+    (r"/api/v1/cooldown", APICooldownHandler), # GET
     (r"/api/v1/user/devices/([^/]+)", APIUserDeviceHandler), # GET
     (r"/api/v1/user/devices/([^/]+)/active", APIUserDeviceActiveHandler), # GET
     (r"/api/v1/user/settings", APIUserSettingsHandler), # GET, PUT
+    (r"/api/v1/user/reservations", APIUserReservationListHandler), # GET, POST
+    (r"/api/v1/user/reservations/([^/]+)", APIUserReservationHandler), # DELETE
     (r"/api/v1/admins", APIAdminListHandler), # GET, POST
+    (r"/api/v1/providers", APIProviderListHandler), # GET
+    (r"/api/v1/usage", APIUsageHandler), # GET
+    (r"/api/v1/quotas", APIQuotaHandler), # GET, PUT
+    (r"/api/v1/uploads/check", APIUploadCheckHandler), # GET
+    (r"/api/v1/uploads/sessions", APIUploadSessionListHandler), # POST
+    (r"/api/v1/uploads/sessions/([^/]+)", APIUploadSessionHandler), # GET, PUT, DELETE
+    (r"/api/v1/uploads/sessions/([^/]+)/finalize", APIUploadSessionFinalizeHandler), # POST
+    (r"/api/v1/packages", APIPackageListHandler), # GET
+    (r"/api/v1/packages/([0-9a-fA-F]{32})", APIPackageHandler), # GET
     ## Group API
     # (r"/api/v1/user/groups/([^/]+)", APIUserGroupHandler), # GET, POST, DELETE  TODO(ssx)
     (r"/api/v1/user/groups", APIUserGroupListHandler), # GET, POST
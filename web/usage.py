@@ -0,0 +1,179 @@
+# coding: utf-8
+#
+# device usage sessions and hourly, daily rollups
+#
+
+import collections
+import datetime
+
+from logzero import logger
+from tornado.ioloop import PeriodicCallback
+
+from . import settings
+from .database import db, time_now
+
+PERIODS = ("hour", "day")
+KINDS = ("device", "user", "group")
+
+
+def bucket_of(t: datetime.datetime, period: str) -> datetime.datetime:
+    t = t.replace(minute=0, second=0, microsecond=0)
+    if period == "day":
+        t = t.replace(hour=0)
+    return t
+
+
+def next_bucket(t: datetime.datetime, period: str) -> datetime.datetime:
+    step = datetime.timedelta(hours=1 if period == "hour" else 24)
+    return bucket_of(t, period) + step
+
+
+def split_session(began_at: datetime.datetime, ended_at: datetime.datetime,
+                  period: str):
+    """
+    Yields:
+        (bucket, seconds) of each bucket the session spans
+    """
+    t = began_at
+    while t < ended_at:
+        end = min(next_bucket(t, period), ended_at)
+        yield bucket_of(t, period), (end - t).total_seconds()
+        t = end
+
+
+def _merge_rollup(id, old, new):
+    return old.merge({
+        "seconds": old["seconds"].add(new["seconds"]),
+        "sessions": old["sessions"].add(new["sessions"]),
+    })  # yapf: disable
+
+
+class UsageRecorder(object):
+    """
+    Acquire and release events are appended to table usage_events, the
+    durations of released sessions are added to table usage_rollups:
+
+        {"id": "day:2019-03-31T00:00:00+08:00:user:someone@example.com",
+         "period": "day", "bucket": datetime, "kind": "user",
+         "key": "someone@example.com", "seconds": 3600.0, "sessions": 2}
+
+    kind is one of device(udid), user(email) and group(owner of device).
+    Events and rollup increments are buffered in memory, and written with
+    one insert each every `flush_interval` seconds.
+    """
+
+    def __init__(self, flush_interval: float):
+        self._flush_interval = flush_interval
+        self._events = []
+        self._rollups = {}  # id -> rollup increment
+        self._timer = None
+
+    def acquired(self, udid: str, email: str):
+        self._append({
+            "type": "acquire",
+            "udid": udid,
+            "userId": email,
+            "at": time_now(),
+        })  # yapf: disable
+
+    def released(self, device: dict):
+        """
+        Args:
+            device: device data before released
+        """
+        began_at, ended_at = device.get('usingBeganAt'), time_now()
+        if not began_at:
+            return
+        began_at = began_at.astimezone(ended_at.tzinfo)  # buckets in +08:00
+        keys = {
+            "device": device['udid'],
+            "user": device.get('userId'),
+            "group": device.get('owner'),
+        }
+        self._append({
+            "type": "release",
+            "udid": device['udid'],
+            "userId": keys['user'],
+            "owner": keys['group'] or "",
+            "beganAt": began_at,
+            "at": ended_at,
+            "duration": (ended_at - began_at).total_seconds(),
+        })  # yapf: disable
+        for period in PERIODS:
+            first = True
+            for bucket, seconds in split_session(began_at, ended_at, period):
+                for kind, key in keys.items():
+                    if key:
+                        self._add(period, bucket, kind, key, seconds,
+                                  1 if first else 0)
+                first = False
+
+    def _add(self, period, bucket, kind, key, seconds, sessions):
+        id = ":".join([period, bucket.isoformat(), kind, key])
+        rollup = self._rollups.get(id)
+        if rollup is None:
+            rollup = self._rollups[id] = {
+                "id": id,
+                "period": period,
+                "bucket": bucket,
+                "kind": kind,
+                "key": key,
+                "seconds": 0.0,
+                "sessions": 0,
+            }
+        rollup['seconds'] += seconds
+        rollup['sessions'] += sessions
+
+    def _append(self, event: dict):
+        self._events.append(event)
+        if self._timer is None:
+            self._timer = PeriodicCallback(self.flush,
+                                           self._flush_interval * 1000)
+            self._timer.start()
+
+    async def flush(self):
+        events, self._events = self._events, []
+        rollups, self._rollups = self._rollups, {}
+        try:
+            if events:
+                await db.table("usage_events").insert(events)
+            events = []
+            if rollups:
+                await db.table("usage_rollups").insert(
+                    list(rollups.values()), conflict=_merge_rollup)
+        except Exception as e:
+            logger.warning("flush usage error: %s", e)
+            self._events = events + self._events  # retry in next flush
+            for rollup in rollups.values():
+                self._add(rollup['period'], rollup['bucket'], rollup['kind'],
+                          rollup['key'], rollup['seconds'], rollup['sessions'])
+
+    async def report(self,
+                     period: str,
+                     kind: str,
+                     since: datetime.datetime,
+                     until: datetime.datetime,
+                     key: str = None) -> list:
+        """ rollups of buckets in [since, until) """
+        reql = db.table("usage_rollups").between(
+            [period, kind, bucket_of(since, period)], [period, kind, until],
+            index="period_kind_bucket")
+        if key:
+            reql = reql.filter({"key": key})
+        return await reql.order_by("bucket").without("id").all()
+
+    def summary(self, rollups: list) -> list:
+        """ total seconds and sessions of each key, most used first """
+        totals = collections.OrderedDict()
+        for rollup in rollups:
+            total = totals.setdefault(rollup['key'], {
+                "key": rollup['key'],
+                "seconds": 0.0,
+                "sessions": 0
+            })
+            total['seconds'] += rollup['seconds']
+            total['sessions'] += rollup['sessions']
+        return sorted(totals.values(), key=lambda t: -t['seconds'])
+
+
+usage = UsageRecorder(settings.USAGE_FLUSH_INTERVAL)
@@ -12,6 +12,7 @@ from tornado.escape import json_decode
 
 from ..database import db, time_now, r
 from ..libs import jsondate
+from ..libs.codec import JSONCodec, get_codec
 
 from typing import Dict, Union, Optional
 
@@ -133,10 +134,28 @@ class AdminRequestHandler(AuthRequestHandler):
 
 class BaseWebSocketHandler(CurrentUserMixin,
                            tornado.websocket.WebSocketHandler):
-    """ update current_user when websocket created """
+    """
+    update current_user when websocket created
+
+    Message encoding is choosen by ?encoding=json|msgpack, default json
+    """
+
+    codec = JSONCodec
 
     async def prepare(self):
         self.current_user = await self.get_current_user_async()
+        try:
+            self.codec = get_codec(self.get_argument("encoding", None))
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+
+    def write_data(self, data):
+        """ encode and write message, return Future """
+        return self.write_message(self.codec.dumps(data),
+                                  binary=self.codec.binary)
+
+    def decode_message(self, message):
+        return self.codec.loads(message)
 
     def check_origin(self, origin):
         return True
@@ -3,6 +3,7 @@
 
 import datetime
 import json
+import time
 import urllib
 from functools import wraps
 from typing import Union
@@ -13,22 +14,62 @@ from logzero import logger
 from rethinkdb import r
 from tornado import gen
 from tornado.httpclient import AsyncHTTPClient, HTTPRequest
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.web import HTTPError, authenticated
 
+from .. import settings
+from ..activity import activity
+from ..balancer import balancer
+from ..changefeed import DeviceFilter, hub
+from ..cooldown import CooldownJob, cooldown
 from ..database import db, time_now
 from ..libs import jsondate
+from ..liveness import liveness
+from ..quota import QuotaError, quota
+from ..registry import registry
+from ..reservation import reserved_by_others
+from ..scheduler import DeadlineScheduler
+from ..usage import usage
 from ..version import __version__
 from .base import (AuthRequestHandler, BaseRequestHandler,
                    BaseWebSocketHandler, CorsMixin)
 
 
 class AcquireError(Exception):
-    pass
+    """
+    Attributes:
+        reason: one of not_exist, absent, busy, colding, reserved,
+            user_quota, group_quota, batch_quota
+    """
+
+    def __init__(self, description: str, reason: str = "unknown"):
+        super().__init__(description)
+        self.reason = reason
 
 
 class ReleaseError(Exception):
-    pass
+    """
+    Attributes:
+        reason: one of not_exist, not_owner
+    """
+
+    def __init__(self, description: str, reason: str = "unknown"):
+        super().__init__(description)
+        self.reason = reason
+
+
+_ACQUIRE_ERRORS = {
+    "not_exist": "device not exist",
+    "absent": "device absent",
+    "busy": "device busy",
+    "colding": "device is colding",
+    "reserved": "device is reserved by others",
+}
+
+_RELEASE_ERRORS = {
+    "not_exist": "device not exist",
+    "not_owner": "device is not owned by you",
+}
 
 
 class APIDeviceListHandler(CorsMixin, BaseRequestHandler):
@@ -80,12 +121,21 @@ class APIUserDeviceActiveHandler(AuthRequestHandler):
 
     async def get(self, udid):
         # """ update lastActivatedAt """
-        ret = await db.table("devices").filter({
-            "using": True,
-            "udid": udid,
-            "userId": self.current_user.email
-        }).update({"lastActivatedAt": time_now()}) # yapf: disable
-        if ret['replaced']:
+        email = self.current_user.email
+        owner = activity.owners.get(udid)
+        if not owner or owner[0] != email:  # cache may be late, check again
+            device = await db.table("devices").get(udid).run()
+            owner = None
+            if device and device.get('using'):
+                owner = (device.get('userId'), device['idleTimeout'])
+                activity.acquired(udid, *owner)
+            elif udid in activity.owners:
+                activity.released(udid)
+
+        if owner and owner[0] == email:
+            # written to database later in batch, then idle deadline is
+            # updated by the leader through devices changefeed
+            activity.touch(udid, email)
             self.write_json({
                 "success": True,
                 "description": "Device activated time updated"
@@ -98,6 +148,33 @@ class APIUserDeviceActiveHandler(AuthRequestHandler):
             })
 
 
+class APIUserDevicesActiveHandler(AuthRequestHandler):
+    """ update active time of all devices using by current user """
+
+    async def get(self):
+        ret = await db.table("devices").get_all(
+            self.current_user.email, index="userId").filter({
+                "using": True
+            }).update({"lastActivatedAt": time_now()}, return_changes=True) # yapf: disable
+        udids = []
+        for change in ret.get('changes', []):
+            device = change['new_val']
+            activity.acquired(device['udid'], device['userId'], device['idleTimeout']) # yapf: disable
+            udids.append(device['udid'])
+        self.write_json({
+            "success": True,
+            "description": "%d devices activated time updated" % len(udids),
+            "udids": udids,
+        })
+
+
+class APICooldownHandler(AuthRequestHandler):
+    """ cooldown queue metrics of this server process """
+
+    def get(self):
+        self.write_json({"success": True, "cooldown": cooldown.metrics()})
+
+
 def catch_error_wraps(*errors):
     """ write 400 if error raises """
 
@@ -123,6 +200,7 @@ class APIDeviceHandler(CorsMixin, BaseRequestHandler):
     @catch_error_wraps(rdb.errors.ReqlNonExistenceError)
     async def get(self, udid):
         data = await db.table("devices").get(udid).without("sources").run()
+        data['liveness'] = liveness.device_info(udid)
         self.write_json({
             "success": True,
             "device": data,
@@ -183,13 +261,17 @@ class APIUserDeviceHandler(CorsMixin, AuthRequestHandler):
             }) # yapf: disable
             return
 
-        # Find the highest priority source
-        source = None
-        priority = 0
-        for s in data.get('sources', {}).values():
-            if s['priority'] > priority:
-                source = s
-                priority = s['priority']
+        # Source is choosen by load and latency when acquired, then stick
+        # to it until release
+        sources = data.get('sources', {})
+        source = sources.get(data.get('sourceId'))
+        if source is None:  # acquired by older version, or source is gone
+            if data.get('using'):
+                source = await D(udid).choose_source(data)
+            else:
+                source, _ = balancer.choose(list(sources.values()))
+        if source:  # scored the same as balancer.choose
+            source = dict(source, score=balancer.score(source['id']))
         data['source'] = source
 
         self.write_json({
@@ -219,6 +301,7 @@ class APIUserDeviceHandler(CorsMixin, AuthRequestHandler):
         data = self.get_payload()
         udid = data["udid"]
         idle_timeout = data.get('idleTimeout', 600)  # 默认10分钟
+        priority = data.get('priority', 'interactive')  # or batch
         email = self.current_user.email
 
         # Admin: change user email
@@ -232,15 +315,19 @@ class APIUserDeviceHandler(CorsMixin, AuthRequestHandler):
                         self.current_user.email, email)
 
         try:
-            await D(udid).acquire(email, idle_timeout)
+            await D(udid).acquire(email, idle_timeout, priority)
             self.write_json({
                 "success": True,
                 "description": "Device successfully added"
             })
+        except ValueError as e:
+            self.set_status(400)
+            self.write_json({"success": False, "description": str(e)})
         except AcquireError as e:
             self.set_status(403)  # forbidden
             self.write_json({
                 "success": False,
+                "reason": e.reason,
                 "description": "Device add failed: " + str(e),
             })
 
@@ -257,6 +344,7 @@ class APIUserDeviceHandler(CorsMixin, AuthRequestHandler):
             self.set_status(403)  # forbidden
             self.write_json({
                 "success": False,
+                "reason": e.reason,
                 "description": "Device release failed: " + str(e),
             })
 
@@ -326,45 +414,182 @@ class DeviceListHandler(AuthRequestHandler):
 
 
 class DeviceChangesWSHandler(BaseWebSocketHandler):
+    """
+    Push device changes to client
+
+    Old clients only receive {"event": "insert"|"update", "data": {...}}
+
+    Subscribe protocol, enabled by ?include_initial=true&resume=<token>
+    or by sending message
+
+        {"command": "subscribe", "include_initial": true, "resume": "<token>",
+         "filters": {"platform": "android", "udids": [...], ...}}
+
+    Filters (see DeviceFilter) are checked before message is serialized,
+    and can be changed by sending subscribe message again. Without
+    include_initial, devices leaving the new filter are sent as delete and
+    devices entering it as insert.
+
+    Server will send
+        {"event": "snapshot", "token": "...", "devices": [...]}
+        {"event": "resume", "token": "..."}  # followed by missed changes
+        {"event": "insert"|"update"|"delete", "token": "...", "data": {...}}
+
+    When resume token is too old, snapshot is sent instead.
+    """
+
+    def initialize(self):
+        self._legacy = True
+        self._pending = None  # changes received while loading snapshot
+        self._filter = DeviceFilter()
+
+    def get_compression_options(self):
+        """ enable permessage-deflate, snapshot may be very large """
+        if settings.WS_COMPRESSION_LEVEL <= 0:
+            return None
+        return {"compression_level": settings.WS_COMPRESSION_LEVEL}
+
     async def write_json(self, data: dict):
-        await self.write_message(jsondate.dumps(data))
-        # try:
-        #     self.write_message(jsondate.dumps(data))
-        # except tornado.websocket.WebSocketClosedError:
-        #     self.__opened = False
+        await self.write_data(data)
 
-    async def send_feed(self):
-        def filter_accessible(v):  # filter out private device
-            groups = self.current_user.get("groups", {}).keys()
-            groups = list(groups) + [self.current_user.email, ""]
-            return r.expr(groups).contains(v['owner'].default(""))
+    def _send(self, data: dict):
+        """ send without waiting, so that message order is kept """
+        try:
+            self.write_data(data)
+        except tornado.websocket.WebSocketClosedError:
+            hub.unsubscribe(self._on_change)
+
+    def _match(self, device: dict, device_filter: DeviceFilter = None) -> bool:
+        device_filter = device_filter or self._filter
+        if not device or not device_filter.match(device):
+            return False
+        if self.current_user.admin:
+            return True
+        groups = list(self.current_user.get("groups", {}).keys())
+        groups += [self.current_user.email, ""]  # include user-private device
+        return device.get("owner", "") in groups
+
+    def _deliver(self, change: dict):
+        if self._legacy:
+            if change['event'] != "delete" and self._match(change['data']):
+                self._send({"event": change['event'], "data": change['data']})
+            return
 
-        reql = db.table_devices
-        if not self.current_user.admin:
-            reql = reql.filter(filter_accessible)
+        old_match = self._match(change['old'])
+        new_match = change['event'] != "delete" and self._match(change['data']) # yapf: disable
+        if new_match:
+            event = "update" if old_match else "insert"
+        elif old_match:
+            event = "delete"
+        else:
+            return
+        self._send({
+            "event": event,
+            "token": hub.make_token(change['seq']),
+            "data": change['data'],
+        })  # yapf: disable
 
-        conn, feed = await reql.watch()
-        with conn:
-            while await feed.fetch_next():
-                if not self.__opened:
-                    break
-                data = await feed.next()
-                await self.write_json({
-                    "event": "insert" if data['old_val'] is None else 'update',
-                    "data": data['new_val'],
-                })  # yapf: disable
+    def _on_change(self, change: dict):
+        if change['event'] == "reset":  # changefeed reconnected
+            if not self._legacy:
+                IOLoop.current().spawn_callback(self._send_snapshot)
+            return
+        if self._pending is not None:
+            self._pending.append(change)
+            return
+        self._deliver(change)
+
+    async def _load_devices(self, send):
+        """ changes received while loading are delivered after send(devices) """
+        self._pending = []
+        token = hub.token
+        try:
+            devices = await db.table_devices.order_by(r.desc("createdAt")).all()
+            send(token, devices)
+        finally:
+            pending, self._pending = self._pending, None
+            for change in pending:
+                self._deliver(change)
+
+    async def _send_snapshot(self):
+        def send(token, devices):
+            self._send({
+                "event": "snapshot",
+                "token": token,
+                "devices": [d for d in devices if self._match(d)],
+            })  # yapf: disable
+
+        await self._load_devices(send)
+
+    async def _send_filter_diff(self, old_filter: DeviceFilter):
+        """ filter changed, send devices leaving or entering it """
+
+        def send(token, devices):
+            for d in devices:
+                old_match, new_match = self._match(d, old_filter), self._match(d) # yapf: disable
+                if old_match != new_match:
+                    self._send({
+                        "event": "insert" if new_match else "delete",
+                        "token": token,
+                        "data": d,
+                    })  # yapf: disable
+
+        await self._load_devices(send)
+
+    async def _subscribe(self, include_initial=False, resume=None,
+                         filters=None):
+        old_filter = self._filter
+        try:
+            self._filter = DeviceFilter(filters)
+        except ValueError as e:
+            self._send({"success": False, "description": str(e)})
+            return
+        self._legacy = False
+        if not include_initial and not resume:
+            if self._filter != old_filter:
+                await self._send_filter_diff(old_filter)
+            return
+        if resume:
+            changes = hub.replay(resume)
+            if changes is not None:
+                self._send({"event": "resume", "token": resume})
+                for change in changes:
+                    self._deliver(change)
+                return
+            include_initial = True  # resume failed, client need a full list
+        if include_initial:
+            await self._send_snapshot()
 
     async def open(self):
-        self.__opened = True
-        IOLoop.current().add_callback(self.send_feed)
+        if not self.current_user:
+            self.close(reason="need to login")
+            return
+        filters = None
+        if self.get_argument("platform", ""):
+            filters = {"platform": self.get_argument("platform")}
+        self._filter = DeviceFilter(filters)
+        hub.subscribe(self._on_change)
 
-    def on_message(self, msg):
-        # logger.debug("receive message %s", msg)
-        pass
+        include_initial = self.get_argument("include_initial", "") in ("1", "true") # yapf: disable
+        resume = self.get_argument("resume", None)
+        if include_initial or resume:
+            await self._subscribe(include_initial, resume, filters)
+
+    async def on_message(self, msg):
+        try:
+            req = self.decode_message(msg)
+        except ValueError:  # web page send "ping" to keep alive
+            return
+        if not isinstance(req, dict):
+            return
+        if req.get("command") == "subscribe":
+            await self._subscribe(
+                bool(req.get("include_initial")), req.get("resume"),
+                req.get("filters"))
 
     def on_close(self):
-        self.__opened = False
-        print("Websocket closed")
+        hub.unsubscribe(self._on_change)
+        logger.debug("devicechanges websocket closed")
 
 
 class D(object):
@@ -376,74 +601,92 @@ class D(object):
     async def update(self, data: dict):
         return await db.table("devices").get(self.udid).update(data)
 
-    async def acquire(self, email: str, idle_timeout: int = 20 * 60):
+    async def acquire(self,
+                      email: str,
+                      idle_timeout: int = 20 * 60,
+                      priority: str = "interactive"):
         """
+        Check and update in one query, so two users can not get the same
+        device. Source of the session is choosen in the same query.
+
         Raises:
-            AcquireError
+            AcquireError, ValueError(unknown priority)
         """
-        device = await db.table("devices").get(self.udid).run()
-        if not device:
-            raise AcquireError("device not exist")
-        if not device.get('sources'):  # 设备离线
-            raise AcquireError("device absent")
-        if device.get('using'):  # 使用中
-            if device.get('userId') == email:
-                # already used by ..{email}
-                return
-            raise AcquireError("device busy")
-        if device.get("colding"):  # 冷却中
-            raise AcquireError("device is colding")
-
-        ret = await db.table("devices").get(self.udid).update({"using": True})
-        if ret['skipped'] == 1:  # 被其他人占用了
-            raise AcquireError(
-                "not fast enough, device have been taken from others")
         now = time_now()
-        await self.update({
-            "userId": email,
-            "usingBeganAt": now,
-            "lastActivatedAt": now,
-            "idleTimeout": idle_timeout,
-        })
-        self.release_until_idle()  # release when idleTimeout
-
-    def release_until_idle(self):
-        async def first_check():
-            device = await db.table("devices").get(self.udid).run()
-            began_at = device['usingBeganAt']
-            after_seconds = self._next_check_after(device) + 3
-            logger.info("First check after %d seconds", after_seconds)
-            IOLoop.current().add_callback(self._check, began_at, after_seconds)
-
-        IOLoop.current().spawn_callback(first_check)
-
-    def _next_check_after(self, device) -> int:
-        time_deadline = device['lastActivatedAt'] + datetime.timedelta(
-            seconds=device['idleTimeout'])
-        delta = time_deadline - time_now()
-        return max(0, int(delta.total_seconds()))
-
-    async def _check(self, began_at: datetime.datetime.time,
-                     idle_timeout: int):
-        """ when time_now > lastActivatedAt + idleTimeout, release device """
-        await gen.sleep(idle_timeout)
-
-        device = await db.table("devices").get(self.udid).run()
-        # 当开始使用时间不一致时，说明设备已经换人了
-        if began_at != device['usingBeganAt']:
-            logger.info("_check different began_at %s != %s",
-                        device['usingBeganAt'], began_at)
-            return
+        scores, unknown_score = balancer.scores()
+        scores = r.expr(scores)
+
+        def best_source(d):
+            """ same order as balancer.choose """
+            sources = d["sources"]
+            return sources.keys().order_by(
+                lambda id: scores[id].default(unknown_score),
+                r.desc(lambda id: sources[id]["priority"].default(0))).nth(0) # yapf: disable
+
+        def check_and_set(d):
+            using = d["using"].default(False)
+            return r.branch(
+                d["sources"].default({}).keys().count().eq(0), r.error("absent"),  # 设备离线
+                using.and_(d["userId"].default(None).eq(email)), {},  # already used by ..{email}
+                reserved_by_others(d, email, now), r.error("reserved"),  # 已被他人预约
+                using, r.error("busy"),  # 使用中
+                d["colding"].default(False), r.error("colding"),  # 冷却中
+                {
+                    "using": True,
+                    "userId": email,
+                    "usingBeganAt": now,
+                    "lastActivatedAt": now,
+                    "idleTimeout": idle_timeout,
+                    "priority": priority,
+                    "sourceId": best_source(d),
+                }) # yapf: disable
+
+        # counted before update, so concurrent acquires see it
+        try:
+            reserved = quota.reserve(self.udid, email, priority)
+        except QuotaError as e:
+            raise AcquireError(str(e), e.reason)
+        try:
+            ret = await db.table("devices").get(self.udid).update(
+                check_and_set, return_changes=True)
+        except Exception:
+            quota.rollback(self.udid, reserved)
+            raise
+        if ret['errors']:
+            quota.rollback(self.udid, reserved)
+            reason = ret['first_error']
+            raise AcquireError(_ACQUIRE_ERRORS.get(reason, reason), reason)
+        if ret['skipped']:
+            quota.rollback(self.udid, reserved)
+            raise AcquireError(_ACQUIRE_ERRORS['not_exist'], "not_exist")
+        quota.confirm(self.udid, reserved)
+        if ret['replaced']:
+            activity.acquired(self.udid, email, idle_timeout)
+            usage.acquired(self.udid, email)
+            # released when idleTimeout by the leader, see watch_idle
 
-        # calculate left time
-        left_seconds = self._next_check_after(device)
-        logger.info("Left seconds: %s", left_seconds)
-        if left_seconds == 0:
-            await self.release(device['userId'])
-            return
+    async def choose_source(self, device: dict):
+        """
+        Choose source for the session of device acquired without it
 
-        # 等待进入下一次检查
-        IOLoop.current().add_callback(self._check, began_at, left_seconds + 3)
+        Returns:
+            source or None if device has no source
+        """
+        sources = device.get('sources') or {}
+        source, _ = balancer.choose(list(sources.values()))
+        if not source:
+            return None
+
+        def set_if_unset(d):
+            same_session = d["using"].default(False).and_(
+                d["userId"].default(None).eq(device.get('userId')))
+            return r.branch(
+                same_session.and_(d["sourceId"].default(None).eq(None)),
+                {"sourceId": source['id']},
+                {}) # yapf: disable
+
+        await db.table("devices").get(self.udid).update(set_if_unset)
+        return source
 
     async def release(self, email: Union[str, None]):
         """
@@ -452,74 +695,369 @@ class D(object):
         Raises:
             ReleaseError
         """
-        device = await db.table("devices").get(self.udid).run()
-        if not device:
-            raise ReleaseError("device not exist")
-        if email and device.get('userId') != email:
-            raise ReleaseError("device is not owned by you")
+        now = time_now()
 
-        if not device.get("using"):  # already released
-            return
+        def check_and_set(d):
+            owned = r.expr(not email).or_(d["userId"].default(None).eq(email))
+            return r.branch(
+                d["using"].default(False).not_(), {},  # already released
+                owned.not_(), r.error("not_owner"),
+                _released(d, now)) # yapf: disable
 
         # Update database
-        await self.update({
-            "using": False,
-            "userId": None,
-            "colding": True,
-            "usingDuration": r.row["usingDuration"].default(0).add(r.now().sub(r.row["usingBeganAt"]))
-        }) # yapf: disable
+        ret = await db.run(
+            r.table("devices").get(self.udid).update(
+                check_and_set, return_changes=True))
+        if ret['errors']:
+            reason = ret['first_error']
+            raise ReleaseError(_RELEASE_ERRORS.get(reason, reason), reason)
+        if ret['skipped']:
+            raise ReleaseError(_RELEASE_ERRORS['not_exist'], "not_exist")
+        if not ret['replaced']:  # already released
+            return
+        self.after_release(ret['changes'][0]['old_val'])
+
+    def after_release(self, device: dict):
+        """
+        Args:
+            device: device data before released
+        """
+        from .provider import ProviderHeartbeatWSHandler
+
+        idle_scheduler.cancel(self.udid)
+        ProviderHeartbeatWSHandler.forget_digest(self.udid)
+        activity.released(self.udid)
+        usage.released(device)
+        quota.released(self.udid)
+        DeviceBookWSHandler.lost(self.udid)
 
         # 设备先要冷却一下(Provider清理并检查设备)
         source = device2source(device)
         if not source:  # 设备离线了
             return
-        
+
+        source_id = source.get("id")
+        if not source.get('url'):
+            IOLoop.current().spawn_callback(self.update, {"colding": False})
+            return
+
         async def cold_device():
-            from tornado.httpclient import HTTPError
-            from tornado.httpclient import AsyncHTTPClient, HTTPRequest
-            http_client = AsyncHTTPClient()
-            secret = source.get('secret', '')
-            if not source.get('url'):
-                await self.update({"colding": False})
+            if source.get("rpc"):  # reuse the websocket of provider
+                await registry.call(source_id, {
+                    "command": "cold",
+                    "udid": device['udid'],
+                }, timeout=settings.COOLDOWN_TIMEOUT)  # yapf: disable
                 return
-            
-            source_id = source.get("id")
-            from .provider import ProviderHeartbeatWSHandler
-            await ProviderHeartbeatWSHandler.release(source_id, device['udid'])
 
-            try:
-                url = source['url'] + "/cold?" + urllib.parse.urlencode(
-                    dict(udid=device['udid'], secret=secret))
-                request = HTTPRequest(url, method="POST", body='')
-                await http_client.fetch(request)
-            except HTTPError as e:
-                logger.error("device [%s] release error: %s", self.udid, e)
-                await self.update({"colding": False})
+            await ProviderHeartbeatWSHandler.release(source_id, device['udid'])
 
-        IOLoop.current().add_callback(cold_device)
+            url = source['url'] + "/cold?" + urllib.parse.urlencode(
+                dict(udid=device['udid'], secret=source.get('secret', '')))
+            request = HTTPRequest(url,
+                                  method="POST",
+                                  body='',
+                                  request_timeout=settings.COOLDOWN_TIMEOUT)
+            await AsyncHTTPClient().fetch(request)
+
+        async def cold_failed():
+            balancer.cooldown_failed(source_id)
+            await self.update({"colding": False})
+            ProviderHeartbeatWSHandler.forget_digest(self.udid)
+
+        cooldown.submit(
+            CooldownJob(self.udid, source_id, cold_device, cold_failed))
+
+
+def _released(d, now: datetime.datetime) -> dict:
+    """ fields updated when device released """
+    return {
+        "using": False,
+        "userId": None,
+        "colding": True,
+        "coldingAt": now,
+        "sourceId": None,
+        "usingDuration": d["usingDuration"].default(0).add(
+            r.expr(now).sub(d["usingBeganAt"])),
+    }  # yapf: disable
+
+
+def idle_deadline(device: dict) -> float:
+    """
+    timestamp when device should be released, keep-alive received by other
+    processes before idleTimeout may be not written yet until max_delay
+    """
+    return device['lastActivatedAt'].timestamp() + device['idleTimeout'] \
+        + activity.max_delay
+
+
+async def release_idle_devices(udids: list):
+    """
+    release devices when time_now > lastActivatedAt + idleTimeout + max_delay
+
+    Devices are checked again in database in the same conditional update,
+    so keep-alive flushed by other server process in time is not lost.
+    """
+    # keep-alive not written to database yet
+    expired = []
+    for udid in udids:
+        last_active, owner = activity.last_active(udid), activity.owners.get(udid) # yapf: disable
+        if owner and DeviceBookWSHandler.held(udid):  # websocket still open
+            idle_scheduler.schedule(udid, time.time() + owner[1])
+        elif last_active and owner and \
+                last_active.timestamp() + owner[1] > time.time():
+            idle_scheduler.schedule(udid, last_active.timestamp() + owner[1])
+        else:
+            expired.append(udid)
+    if not expired:
+        return
+    udids = expired
+    try:
+        await activity.flush(udids)
+    except Exception as e:
+        # do not release devices with unsaved keep-alive, check again later
+        logger.warning("flush activity error: %s", e)
+        for udid in udids:
+            idle_scheduler.schedule(udid, time.time() + settings.ACTIVITY_FLUSH_INTERVAL) # yapf: disable
+        return
+
+    now = time_now()
+
+    def release_if_idle(d):
+        idle = d["using"].default(False).and_(
+            d["lastActivatedAt"].add(d["idleTimeout"]).add(
+                activity.max_delay).le(now))
+        return r.branch(idle, _released(d, now), {})
+
+    ret = await db.run(
+        r.table("devices").get_all(*udids).update(
+            release_if_idle, return_changes=True))
+    released = set()
+    for change in ret.get('changes', []):
+        device = change['old_val']
+        logger.info("Device: %s is released for idle timeout", device['udid']) # yapf: disable
+        released.add(device['udid'])
+        D(device['udid']).after_release(device)
+
+    # 还在使用中, 等待进入下一次检查
+    left = [udid for udid in udids if udid not in released]
+    if left:
+        devices = await db.table("devices").get_all(*left).filter({
+            "using": True
+        }).pluck("udid", "lastActivatedAt", "idleTimeout").all()
+        for d in devices:
+            idle_scheduler.schedule(d['udid'], idle_deadline(d))
+
+
+idle_scheduler = DeadlineScheduler(release_idle_devices)
+
+
+def _schedule_idle(change: dict):
+    if change['event'] == "reset":  # changes may be lost
+        IOLoop.current().spawn_callback(db.restore)
+        return
+    device = change['data']
+    if change['event'] == "delete" or not device.get('using'):
+        idle_scheduler.cancel(device['udid'])
+    elif device.get('lastActivatedAt') and device.get('idleTimeout') is not None: # yapf: disable
+        idle_scheduler.schedule(device['udid'], idle_deadline(device))
+
+
+def watch_idle(leader: bool):
+    """
+    Idle deadlines of all the using devices belong to the leader, no
+    matter which process acquired the device. They are loaded from
+    database when elected, then kept up to date by devices changefeed.
+    """
+    if leader:
+        hub.subscribe(_schedule_idle)
+        IOLoop.current().spawn_callback(db.restore)
+    else:
+        hub.unsubscribe(_schedule_idle)
+        idle_scheduler.clear()
+
+
+registry.on_leader.append(watch_idle)
 
 
 def device2source(device: dict):
-    sources = device.get('sources', {}).values()
-    for s in sorted(sources, key=lambda v: v['priority'], reverse=True):
-        return s
+    """ source used by current session, or the best one """
+    sources = device.get('sources', {})
+    if device.get('sourceId') in sources:
+        return sources[device['sourceId']]
+    source, _ = balancer.choose(list(sources.values()))
+    return source
 
 
 class DeviceBookWSHandler(BaseWebSocketHandler):
-    """ 连接成功时占用，断开时释放设备 """
+    """
+    连接成功时占用，断开时释放设备
 
-    async def open(self, udid):
+    Devices are held as long as the websocket is open, no need to call
+    /active. Many devices can be held by one connection:
+
+        {"command": "acquire", "udid": "xxxx", "idleTimeout": 600}
+        {"command": "release", "udid": "xxxx"}
+
+    Server will send
+        {"event": "acquired"|"released", "udid": "xxxx"}
+        {"event": "error", "udid": "xxxx", "reason": "busy", "description": ..}
+        {"event": "lost", "udid": "xxxx"}  # released by others or provider offline
+
+    When connection is closed, devices are released after
+    LEASE_GRACE_PERIOD seconds, unless acquired again by the same user.
+
+    Held devices are kept active as if /active is called, so the leader
+    does not release them for idle, see keep_alive.
+    """
+    leases = {}  # udid -> handler
+    releasing = {}  # udid -> (email, timeout handle), waiting grace period
+    _keeper = None
+
+    def initialize(self):
+        self._udids = set()
+
+    @property
+    def ping_interval(self):
+        """ detect half-open connections, so devices will not be held forever """
+        return settings.LEASE_PING_INTERVAL or None
+
+    async def open(self, udid=None):
         if not self.current_user:
-            self.write_message("need to login")
+            self.write_data({"event": "error", "description": "need to login"})
             self.close()
             return
-
-        email = self.current_user.email
+        if DeviceBookWSHandler._keeper is None:
+            DeviceBookWSHandler._keeper = PeriodicCallback(
+                self.keep_alive, settings.ACTIVITY_FLUSH_INTERVAL * 1000)
+            DeviceBookWSHandler._keeper.start()
+        if udid:
+            await self._on_acquire({"udid": udid})
+
+    @classmethod
+    def keep_alive(cls):
+        """ touch held devices when half of idleTimeout has passed """
+        held = [(udid, ws.current_user.email) for udid, ws in cls.leases.items()] # yapf: disable
+        held += [(udid, email) for udid, (email, _) in cls.releasing.items()]
+        now = time.time()
+        for udid, email in held:
+            owner = activity.owners.get(udid)
+            if not owner or owner[0] != email:
+                continue
+            last_active = activity.last_active(udid)
+            if last_active is None or \
+                    now - last_active.timestamp() > owner[1] / 2:
+                activity.touch(udid, email)
+
+    async def on_message(self, message):
         try:
-            await D(udid).acquire(email)
-        except AcquireError as e:
-            self.write_message(str(e))
-            self.close()
+            req = self.decode_message(message)
+        except ValueError:
+            return
+        if not isinstance(req, dict):
             return
+        command = req.get("command")
+        if command == "ping":
+            self.write_data({"event": "pong"})
+        elif command in ("acquire", "release"):
+            await getattr(self, "_on_" + command)(req)
+        else:
+            self.write_data({
+                "event": "error",
+                "description": "unknown command: %s" % command,
+            })  # yapf: disable
+
+    async def _on_acquire(self, req: dict):
+        udid, email = req.get("udid"), self.current_user.email
+        if not udid or not isinstance(udid, str):
+            self.write_data({
+                "event": "error",
+                "udid": udid,
+                "reason": "invalid",
+                "description": "udid is required",
+            })  # yapf: disable
+            return
+        try:
+            # no-op when device is already used by the same user
+            await D(udid).acquire(email, req.get("idleTimeout", 600),
+                                  req.get("priority", "interactive"))
+        except (AcquireError, ValueError) as e:
+            self.write_data({
+                "event": "error",
+                "udid": udid,
+                "reason": getattr(e, "reason", "invalid"),
+                "description": str(e),
+            })  # yapf: disable
+            return
+        pending = self.releasing.pop(udid, None)
+        if pending:  # reconnected in grace period
+            IOLoop.current().remove_timeout(pending[1])
+        if self.ws_connection is None:  # closed while acquiring
+            self._hold_after_close(udid)
+            return
+        other = self.leases.get(udid)
+        if other is not None and other is not self:  # moved to this connection
+            other._udids.discard(udid)
+        self.leases[udid] = self
+        self._udids.add(udid)
+        self.write_data({"event": "acquired", "udid": udid})
+
+    async def _on_release(self, req: dict):
+        udid = req.get("udid")
+        if udid not in self._udids:
+            self.write_data({
+                "event": "error",
+                "udid": udid,
+                "reason": "not_owner",
+                "description": "device is not held by this connection",
+            })  # yapf: disable
+            return
+        self._drop(udid)
+        try:
+            await D(udid).release(self.current_user.email)
+        except ReleaseError as e:
+            logger.warning("device [%s] release error: %s", udid, e)
+        self.write_data({"event": "released", "udid": udid})
+
+    def _drop(self, udid: str):
+        self._udids.discard(udid)
+        if self.leases.get(udid) is self:
+            del self.leases[udid]
+
+    @classmethod
+    def lost(cls, udid: str):
+        """ called when device is released in this process """
+        pending = cls.releasing.pop(udid, None)
+        if pending:
+            IOLoop.current().remove_timeout(pending[1])
+        handler = cls.leases.get(udid)
+        if handler:
+            handler._drop(udid)
+            if handler.ws_connection is not None:
+                handler.write_data({"event": "lost", "udid": udid})
+
+    @classmethod
+    def held(cls, udid: str) -> bool:
+        return udid in cls.leases or udid in cls.releasing
+
+    def _hold_after_close(self, udid: str):
+        email = self.current_user.email
+
+        async def expire():
+            if self.releasing.get(udid, (None, ))[0] != email:
+                return
+            del self.releasing[udid]
+            logger.info("Device: %s lease of %s expired", udid, email)
+            try:
+                await D(udid).release(email)
+            except ReleaseError as e:
+                logger.warning("device [%s] release error: %s", udid, e)
+
+        timeout = IOLoop.current().call_later(settings.LEASE_GRACE_PERIOD,
+                                              expire)
+        self.releasing[udid] = (email, timeout)
 
-        self.write_message("device is yours")
+    def on_close(self):
+        for udid in list(self._udids):
+            if self.leases.get(udid) is self:
+                self._hold_after_close(udid)
+            self._drop(udid)
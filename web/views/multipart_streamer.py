@@ -7,6 +7,11 @@ import re
 import tempfile
 import hashlib
 import shutil
+import collections
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
 
 
 class ParseError(Exception):
@@ -35,7 +40,8 @@ class StreamedPart(object):
     def feed(self, data):
         """Feed data into the stream.
 
-        :param data: Binary string that has arrived from the client."""
+        :param data: Binary string or memoryview that has arrived from the client.
+            A memoryview is only valid during this call, copy it with bytes() if it must be kept."""
         raise NotImplementedError
 
     def finalize(self):
@@ -194,6 +200,116 @@ class TemporaryFileStreamedPart(StreamedPart):
         return self.f_out.read()
 
 
+class ThreadedFileStreamedPart(TemporaryFileStreamedPart):
+    """A streamed part that writes and hashes data in an executor.
+
+    Chunks are copied into a queue, and written in order by at most one executor task at a time, so the IOLoop
+    never waits for the disk. When more than ``max_pending`` chunks are waiting, ``wait_writable()`` returns a
+    Future which is resolved when the queue is half empty, return it from ``data_received`` to stop reading from
+    the client (flow control).
+
+    ``finalize()`` only tells that no more data will come, ``wait_finalized()`` returns a Future resolved after
+    all data is written and ``md5sum`` is set. ``release()`` never blocks, the temporary file is deleted after the
+    running write task is finished.
+    """
+    def __init__(self, streamer, headers, executor, tmp_dir=None, max_pending=32):
+        super(ThreadedFileStreamedPart, self).__init__(streamer, headers, tmp_dir)
+        self._executor = executor
+        self._queue = collections.deque()
+        self._max_pending = max_pending
+        self._writing = False  # a write task is running in executor
+        self._writable = None  # Future waiting for the queue to drain
+        self._finalizing = False
+        self._finalized = Future()
+        self._error = None
+        self._released = False
+
+    def feed(self, data):
+        """Queue a copy of data, it will be written in the executor."""
+        if self._error:
+            raise self._error
+        self._queue.append(bytes(data))
+        self._write_next()
+
+    def wait_writable(self):
+        """Return a Future if too many chunks are waiting to be written, otherwise None."""
+        if self._error is not None:
+            return None  # feed() will raise the error
+        if len(self._queue) < self._max_pending:
+            return None
+        if self._writable is None:
+            self._writable = Future()
+        return self._writable
+
+    def _wakeup(self):
+        """Resolve the writable Future when the queue is half empty."""
+        if self._writable is None:
+            return
+        if self._error is None and len(self._queue) > self._max_pending // 2:
+            return
+        future, self._writable = self._writable, None
+        future.set_result(None)
+
+    def _write(self, chunks):
+        """Called in executor"""
+        for data in chunks:
+            self.f_out.write(data)
+            self._m.update(data)
+        self.f_out.flush()
+
+    def _write_next(self):
+        """Start a write task with all the queued chunks, unless one is running."""
+        if self._writing or self._error is not None or not self._queue:
+            return
+        chunks = list(self._queue)
+        self._queue.clear()
+        self._writing = True
+        IOLoop.current().add_future(self._executor.submit(self._write, chunks), self._on_written)
+        self._wakeup()
+
+    def _on_written(self, future):
+        self._writing = False
+        if self._released:  # cleanup deferred by release()
+            super(ThreadedFileStreamedPart, self).release()
+            return
+        try:
+            future.result()
+        except Exception as e:
+            self._error = e
+            self._queue.clear()
+            self._wakeup()
+        self._write_next()
+        self._check_finalized()
+
+    def _check_finalized(self):
+        if not self._finalizing or self._writing or self._finalized.done():
+            return
+        if self._error is not None:
+            self._finalized.set_exception(self._error)
+        elif not self._queue:
+            self.md5sum = self._m.hexdigest()
+            self.is_finalized = True
+            self._finalized.set_result(None)
+
+    def finalize(self):
+        self._finalizing = True
+        self._check_finalized()
+
+    def wait_finalized(self):
+        return self._finalized
+
+    def release(self):
+        """Drop queued chunks and delete the temporary file, after the running write task if any."""
+        if self._released:
+            return
+        self._released = True
+        self._error = self._error or Exception("part released")
+        self._queue.clear()
+        self._wakeup()
+        if not self._writing:
+            super(ThreadedFileStreamedPart, self).release()
+
+
 class MultiPartStreamer(object):
     """Parse a stream of multpart/form-data.
 
@@ -216,7 +332,7 @@ class MultiPartStreamer(object):
         :param total: Total number of bytes in the stream. This is what the http client sends as
             the Content-Length header of the whole form.
         """
-        self.buf = b""
+        self.buf = bytearray()  # data not parsed yet, consumed from the front
         self.dlen = None
         self.delimiter = None
         self.in_data = False
@@ -225,21 +341,6 @@ class MultiPartStreamer(object):
         self.total = total
         self.received = 0
 
-    def _get_raw_header(self, data):
-        """Return raw header data.
-
-        Internal method. Do not call directly.
-
-        :param data: A string containing raw data from the form part
-        :return: A tuple of (header_value, tail) where header_value is the first line of the form part.
-            If there is no first line yet (e.g. the whole data is a single line) then header_value will be None.
-        """
-        idx = data.find(self.SEP)
-        if idx >= 0:
-            return data[:idx], data[idx + self.L_SEP:]
-        else:
-            return None, data
-
     def _parse_header(self, header):
         """Parse raw header data.
 
@@ -281,6 +382,13 @@ class MultiPartStreamer(object):
         self.part._size += len(data)
         self.part.feed(data)
 
+    def _feed_buf(self, start, end):
+        """Internal method, feed self.buf[start:end] to the current part without copying it."""
+        if end <= start:
+            return
+        with memoryview(self.buf) as view, view[start:end] as data:
+            self._feed_part(data)
+
     def _end_part(self):
         """Internal method called when receiving the current part has finished.
 
@@ -301,46 +409,54 @@ class MultiPartStreamer(object):
         self.on_progress(self.received, self.total)
         self.buf += chunk
 
-        if not self.delimiter:
-            self.delimiter, self.buf = self._get_raw_header(self.buf)
-            if self.delimiter:
-                self.delimiter += self.SEP
-                self.dlen = len(self.delimiter)
-            elif len(self.buf) > 1000:
-                raise ParseError("Cannot find multipart delimiter")
-            else:
-                return
+        # consumed data is removed once per chunk, only the unparsed tail is moved
+        pos = self._parse()
+        if pos:
+            del self.buf[:pos]
 
+    def _parse(self):
+        """Internal method, parse self.buf and return the number of bytes consumed."""
+        buf = self.buf
+        pos = 0
+        if not self.delimiter:
+            idx = buf.find(self.SEP)
+            if idx < 0:
+                if len(buf) > 1000:
+                    raise ParseError("Cannot find multipart delimiter")
+                return 0
+            self.delimiter = bytes(buf[:idx]) + self.SEP
+            self.dlen = len(self.delimiter)
+            pos = idx + self.L_SEP
+
+        needle = self.SEP + self.delimiter
         while True:
             if self.in_data:
-                if len(self.buf) > 3 * self.dlen:
-                    idx = self.buf.find(self.SEP + self.delimiter)
-                    if idx >= 0:
-                        self._feed_part(self.buf[:idx])
-                        self._end_part()
-                        self.buf = self.buf[idx + len(self.SEP + self.delimiter):]
-                        self.in_data = False
-                    else:
-                        limit = len(self.buf) - 2 * self.dlen
-                        self._feed_part(self.buf[:limit])
-                        self.buf = self.buf[limit:]
-                        return
-                else:
-                    return
-            if not self.in_data:
-                while True:
-                    header, self.buf = self._get_raw_header(self.buf)
-                    if header == b"":
-                        assert self.delimiter
-                        self.in_data = True
-                        self._begin_part(self.headers)
-                        self.headers = []
-                        break
-                    elif header:
-                        self.headers.append(self._parse_header(header))
-                    else:
-                        # Header is None, not enough data yet
-                        return
+                # bytes before pos are fed already, less than 2 * dlen are rescanned
+                idx = buf.find(needle, pos)
+                if idx < 0:
+                    # keep the tail, it may be the beginning of a (closing) delimiter
+                    limit = len(buf) - 2 * self.dlen
+                    if limit > pos:
+                        self._feed_buf(pos, limit)
+                        pos = limit
+                    return pos
+                self._feed_buf(pos, idx)
+                self._end_part()
+                pos = idx + len(needle)
+                self.in_data = False
+
+            while True:
+                idx = buf.find(self.SEP, pos)
+                if idx < 0:  # not enough data yet
+                    return pos
+                header = bytes(buf[pos:idx])
+                pos = idx + self.L_SEP
+                if header == b"":
+                    self.in_data = True
+                    self._begin_part(self.headers)
+                    self.headers = []
+                    break
+                self.headers.append(self._parse_header(header))
 
     def data_complete(self):
         """Call this after the last receive() call, e.g. when all data arrived for the form.
@@ -349,7 +465,7 @@ class MultiPartStreamer(object):
         if self.in_data:
             idx = self.buf.rfind(self.SEP + self.delimiter[:-2])
             if idx > 0:
-                self._feed_part(self.buf[:idx])
+                self._feed_buf(0, idx)
             self._end_part()
 
     def create_part(self, headers):
@@ -420,3 +536,38 @@ class MultiPartStreamer(object):
         :param total: Total bytes to be received.
         """
         pass
+
+
+class ThreadedMultiPartStreamer(MultiPartStreamer):
+    """MultiPartStreamer that writes parts in an executor, see ThreadedFileStreamedPart.
+
+    Usage in a ``stream_request_body`` handler::
+
+        def data_received(self, chunk):
+            self.ps.data_received(chunk)
+            return self.ps.wait_writable()
+
+        async def post(self):
+            self.ps.data_complete()
+            await self.ps.wait_finalized()
+    """
+
+    def __init__(self, total, executor):
+        """
+        :param executor: concurrent.futures.Executor shared by all uploads, used to write parts
+        """
+        super(ThreadedMultiPartStreamer, self).__init__(total)
+        self.executor = executor
+
+    def create_part(self, headers):
+        return ThreadedFileStreamedPart(self, headers, self.executor)
+
+    def wait_writable(self):
+        """Return a Future if the last part can not accept more data yet, otherwise None."""
+        if self.parts:
+            return self.parts[-1].wait_writable()
+        return None
+
+    def wait_finalized(self):
+        """Return a Future resolved when all parts are written to disk."""
+        return gen.multi([part.wait_finalized() for part in self.parts])
@@ -0,0 +1,59 @@
+# coding: utf-8
+#
+
+from ..packages import fileinfo_of, packages
+from .base import AuthRequestHandler
+from .upload import UploadMixin, find_upload
+
+
+class PackageMixin(UploadMixin):
+    def package_data(self, package: dict):
+        """ same data as upload response, None if file is removed """
+        path = find_upload(package['md5'])
+        if not path:
+            return None
+        data = dict(url=self.make_url(path), md5sum=package['md5'])
+        data.update(fileinfo_of(package))
+        data['filename'] = package.get('filename')
+        data['createdAt'] = package.get('createdAt')
+        return data
+
+
+class APIPackageListHandler(PackageMixin, AuthRequestHandler):
+    async def get(self):
+        """
+        Find uploaded builds, the newest first
+
+        Query arguments:
+            packageName: required
+            version: versionName or versionCode, optional
+        """
+        package_name = self.get_argument("packageName")
+        version = self.get_argument("version", None)
+        limit = 20
+        result = []
+        skip = 0
+        while len(result) < limit:  # records of removed files are skipped
+            page = await packages.find(package_name, version, skip, limit)
+            for package in page:
+                data = self.package_data(package)
+                if data and len(result) < limit:
+                    result.append(data)
+            if len(page) < limit:
+                break
+            skip += limit
+        self.write_json({"success": True, "packages": result})
+
+
+class APIPackageHandler(PackageMixin, AuthRequestHandler):
+    async def get(self, md5sum: str):
+        package = await packages.get(md5sum.lower())
+        data = self.package_data(package) if package else None
+        if not data:
+            self.set_status(404)
+            self.write_json({
+                "success": False,
+                "description": "package not found"
+            })
+            return
+        self.write_json({"success": True, "data": data})
@@ -3,35 +3,56 @@
 # handlers for atxslave
 #
 
+import collections
+import datetime
+import hashlib
+import hmac
 import json
+import time
 import uuid
+from tornado import gen
+from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+from tornado.websocket import WebSocketClosedError
 from logzero import logger
 
 from rethinkdb import r
+from .. import settings
+from ..balancer import balancer
+from ..changefeed import hub
 from ..database import db, time_now
-from .base import BaseWebSocketHandler
+from ..liveness import liveness
+from ..registry import ProviderCallError, hash_token, registry
+from .base import AuthRequestHandler, BaseWebSocketHandler
 
 
 class ProviderHeartbeatWSHandler(BaseWebSocketHandler):
     """ monitor device online or offline """
 
-    providers = {}
+    held = {}  # id -> state of disconnected provider in grace period
+    # udid -> times device is changed by server, see forget_digest. only
+    # devices with source of this process are counted
+    _server_writes = collections.Counter()
 
     @staticmethod
     async def release(source_id, udid):
         """
         Release device when finished using
         """
-        ws = ProviderHeartbeatWSHandler.providers.get(source_id)
-        if not ws:
-            return
-        await ws.write_message({"command": "release", "udid": udid})
+        await registry.send(source_id, {"command": "release", "udid": udid})
 
     def initialize(self):
         self._id = None
+        self._token = None  # used to resume after reconnect
         self._owner = None
         self._info = None
+        self._calls = {}  # requestId -> Future waiting for response
+        self._call_seq = 0
+        self._call_sem = Semaphore(settings.PROVIDER_RPC_CONCURRENCY)
+        self._rtt_probed_at = 0
+        self._udids = set()  # devices which has source of this provider
+        self._digests = {}  # udid -> digest of last applied update
 
     def open(self):
         """
@@ -47,7 +68,66 @@ class ProviderHeartbeatWSHandler(BaseWebSocketHandler):
         """
         {"command": "ping"}
         """
-        self.write_message("pong")
+        if self.codec.binary:
+            self.write_data("pong")
+        else:
+            self.write_message("pong")
+
+        # measure round trip time with websocket ping frame
+        now = time.time()
+        if self._id and now - self._rtt_probed_at > 10:
+            self._rtt_probed_at = now
+            self.ping(repr(now).encode())
+
+    def on_pong(self, data: bytes):
+        try:
+            rtt = time.time() - float(data)
+        except ValueError:  # ping send by tornado itself
+            return
+        if self._id and 0 <= rtt < 60:
+            balancer.observe_rtt(self._id, rtt)
+
+    async def call(self, data: dict, timeout: float = None):
+        """
+        Send command and wait for the response
+
+        Server -> Provider
+            {"command": "cold", "udid": "xxxx", "requestId": 1}
+        Provider -> Server
+            {"command": "response", "requestId": 1, "success": true, ...}
+
+        Only providers with "rpc": true in handshake support it.
+
+        Raises:
+            ProviderCallError
+        """
+        timeout = timeout or settings.PROVIDER_RPC_TIMEOUT
+        deadline = datetime.timedelta(seconds=timeout)
+        try:
+            await self._call_sem.acquire(deadline)
+        except gen.TimeoutError:
+            raise ProviderCallError("too many calls in progress")
+        try:
+            self._call_seq += 1
+            request_id = self._call_seq
+            future = self._calls[request_id] = Future()
+            self.write_data(dict(data, requestId=request_id))
+            resp = await gen.with_timeout(deadline, future)
+        except gen.TimeoutError:
+            raise ProviderCallError("call timeout after %ss" % timeout)
+        except WebSocketClosedError:
+            raise ProviderCallError("provider is disconnected")
+        finally:
+            self._calls.pop(request_id, None)
+            self._call_sem.release()
+        if not resp.get("success", True):
+            raise ProviderCallError(resp.get("description") or "call failed")
+        return resp
+
+    async def _on_response(self, req: dict):
+        future = self._calls.get(req.get("requestId"))
+        if future and not future.done():
+            future.set_result(req)
 
     async def _on_handshake(self, req: dict):
         """
@@ -56,7 +136,16 @@ class ProviderHeartbeatWSHandler(BaseWebSocketHandler):
         {"name": "ccddqq",
          "url": "http://xlksdf.com",
          "secret": "xxxxxx....",
-         "owner": "someone@domain.com"}
+         "owner": "someone@domain.com",
+         "rpc": true, # optional, support request/response commands
+         "id": "xxxx", "token": "xxxx"} # optional, to resume after reconnect
+
+        Response:
+        {"success": true, "id": "xxxx", "token": "xxxx", "resumed": false}
+
+        When websocket is closed, devices are kept for PROVIDER_GRACE_PERIOD
+        seconds. If provider reconnect with the same id and token in time,
+        devices will not be touched.
         """
         assert "name" in req
         assert "url" in req
@@ -64,20 +153,103 @@ class ProviderHeartbeatWSHandler(BaseWebSocketHandler):
         assert "priority" in req
         # assert "owner" in req
 
-        self._id = req['id'] = str(uuid.uuid1())
+        resume_id, token = req.pop('id', None), req.pop('token', None)
+        resumed = await self._resume(resume_id, token, req)
+        self._id = req['id'] = resume_id if resumed else str(uuid.uuid1())
+        self._token = uuid.uuid4().hex
         self._owner = req.get('owner', "")
         self._info = req
 
         # hotfix for old provider
         if self._owner == "nobody@nobody.io":
             self._owner = ""
-        self.write_message(json.dumps({
+        self.write_data({
             "success": True,
             "id": self._id,
-        }))
-        self.providers[self._id] = self # providers is global variable
+            "token": self._token,
+            "resumed": resumed,
+        })
+        await registry.register(self._id, self, req, self._token)
+        hub.subscribe(self._on_device_change)
+        liveness.start(self._on_liveness_timeout)
+        liveness.touch(self._id)
         logger.debug("A new provider is online " + req['name'] + " ID:" +
-                     self._id)
+                     self._id + (" (resumed)" if resumed else ""))
+
+    async def _resume(self, id: str, token: str, info: dict) -> bool:
+        """ take over devices from disconnected or half-open connection """
+        if not id or not isinstance(token, str):
+            return False
+        state = self.held.get(id)
+        ws = registry.local.get(id)
+        if state:
+            if not hmac.compare_digest(state['token'], token):
+                return False
+            del self.held[id]
+            IOLoop.current().remove_timeout(state['timeout'])
+        elif ws and ws is not self and ws._token:
+            if not hmac.compare_digest(ws._token, token):
+                return False
+            state = ws._state()
+            ws._id = None  # old connection should not cleanup anymore
+            ws.close()
+        else:
+            state = await self._resume_from_node(id, token)
+            if not state:
+                return False
+
+        self._udids = state['udids']
+        if state['info'] == dict(info, id=id):
+            self._digests = state['digests']
+        return True
+
+    async def _resume_from_node(self, id: str, token: str):
+        """ provider was connected to another server process """
+        record = await registry.lookup(id)
+        if not record or not record.get('tokenHash') or \
+                record.get('node') == registry.node_id:
+            return None
+        if not hmac.compare_digest(record['tokenHash'], hash_token(token)):
+            return None
+        if not await registry.takeover(id, record['node']):
+            return None
+        devices = await db.table("devices").get_all(
+            id, index="source_ids").pluck("udid").all()
+        return {
+            "info": None,
+            "udids": set([d['udid'] for d in devices]),
+            "digests": {},
+        }  # yapf: disable
+
+    @staticmethod
+    def _on_liveness_timeout(source_id: str):
+        """ no message for a long time, maybe a half-open connection """
+        ws = registry.local.get(source_id)
+        if ws:
+            logger.warning("provider %s heartbeat timeout, close it", source_id) # yapf: disable
+            ws.close()
+
+    @classmethod
+    def _on_takeover(cls, source_id: str):
+        """ provider resumed on another node, forget it without cleanup """
+        state = cls.held.pop(source_id, None)
+        if state:
+            IOLoop.current().remove_timeout(state['timeout'])
+            cls._forget_devices(state['udids'])
+        ws = registry.local.get(source_id)
+        if ws:
+            registry.unregister(source_id, ws, keep_record=True)
+            ws._id = None
+            ws.close()
+            cls._forget_devices(ws._udids)
+
+    def _state(self) -> dict:
+        return {
+            "token": self._token,
+            "info": self._info,
+            "udids": self._udids,
+            "digests": self._digests,
+        }
 
 
     async def _on_update(self, req):
@@ -95,55 +267,288 @@ class ProviderHeartbeatWSHandler(BaseWebSocketHandler):
             }
         }
         """
-        updates = req.copy()
-        udid = updates['udid']
+        udid = req['udid']
         assert isinstance(udid, str)
 
-        # add owner
-        updates['owner'] = self._owner
+        digest = self._changed_digest(req)
+        if not digest:
+            return
+        writes = self._server_writes[udid]
+        ret = await self._save_updates([req])
+        if not ret.get('errors'):
+            self._remember_digests({udid: digest}, {udid: writes})
 
-        source = updates.pop('provider', {})
-        if source is None:
-            # remove source
-            await db.table("devices").get(udid).replace(lambda q: q.without(
-                {"sources": {
-                    self._id: True
-                }}))
-        else:
-            # one device may contains many sources
-            source.update(self._info)
-            updates['sources'] = {
-                self._id: source,
-            }
-        updates['updatedAt'] = time_now()
-        await db.table("devices").save(updates, udid)
+    async def _on_updates(self, req):
+        """
+        update many devices in one message
+
+        {
+            "command": "updates",
+            "devices": [{
+                "udid": "xxx12312312",
+                "platform": "android",
+                "provider": {...}, # null means remove source
+                "properties": {...}
+            }, ...]
+        }
+
+        Response:
+        {
+            "command": "updates",
+            "success": true,
+            "results": [{"udid": "xxx12312312", "status": "updated"}, ...]
+        }
+
+        status can be one of updated, unchanged, error
+        """
+        results = []
+        changes = {}
+        digests = {}
+        for item in req.get("devices") or []:
+            udid = item.get("udid") if isinstance(item, dict) else None
+            if not isinstance(udid, str):
+                results.append({
+                    "udid": udid,
+                    "status": "error",
+                    "description": "udid is required",
+                })  # yapf: disable
+                continue
+            result = {"udid": udid, "status": "unchanged"}
+            digest = self._changed_digest(item)
+            if digest:
+                result['status'] = "updated"
+                changes[udid] = item
+                digests[udid] = digest
+            results.append(result)
+
+        if changes:
+            writes = {udid: self._server_writes[udid] for udid in changes}
+            try:
+                ret = await self._save_updates(list(changes.values()))
+                error = ret.get('first_error') if ret.get('errors') else None
+            except Exception as e:
+                logger.warning("provider %s bulk update error: %s", self._id, e) # yapf: disable
+                error = str(e)
+            if error:
+                for result in results:
+                    if result['status'] == "updated":
+                        result['status'] = "error"
+                        result['description'] = error
+            else:
+                self._remember_digests(digests, writes)
+
+        self.write_data({
+            "command": "updates",
+            "success": True,
+            "results": results,
+        })  # yapf: disable
+
+    def _changed_digest(self, req: dict):
+        """
+        provider resend the whole state even nothing changed, compare it
+        with the last applied one to skip useless database write
+
+        Returns:
+            digest of req, None if it is the same as the last applied one
+        """
+        udid = req['udid']
+        liveness.touch(self._id, udid)
+        digest = self._digest(req)
+        if self._digests.get(udid) == digest:
+            return None
+        return digest
+
+    def _remember_digests(self, digests: dict, writes: dict):
+        """
+        called after update is written without error, digest is dropped if
+        server changed the device during writing
+        """
+        for udid, digest in digests.items():
+            if self._server_writes[udid] == writes[udid]:
+                self._digests[udid] = digest
+
+    @classmethod
+    def forget_digest(cls, udid: str):
+        """
+        device is changed by server (release, cooldown), so the same state
+        sent by provider again is not a no-op anymore
+        """
+        if cls._is_local(udid):
+            cls._server_writes[udid] += 1
+        for ws in list(registry.local.values()):
+            ws._digests.pop(udid, None)
+        for state in cls.held.values():
+            state['digests'].pop(udid, None)
+
+    @classmethod
+    def _is_local(cls, udid: str) -> bool:
+        """ device has source of provider connected to this process """
+        return any(udid in ws._udids for ws in registry.local.values()) or \
+            any(udid in state['udids'] for state in cls.held.values())
+
+    @classmethod
+    def _forget_devices(cls, udids):
+        """ sources of devices are removed from this process """
+        for udid in udids:
+            if not cls._is_local(udid):
+                cls._server_writes.pop(udid, None)
+
+    @classmethod
+    def _on_device_change(cls, change: dict):
+        """ catch changes made by other server processes """
+        if change['event'] == "reset":  # changes may be lost
+            for ws in list(registry.local.values()):
+                ws._digests.clear()
+            for state in cls.held.values():
+                state['digests'].clear()
+            return
+        old, new = change['old'] or {}, change['data']
+        if old.get('using') != new.get('using') or \
+                old.get('colding') != new.get('colding') or \
+                set(old.get('sources') or {}) != set(new.get('sources') or {}):
+            cls.forget_digest(new['udid'])
+
+    async def _save_updates(self, reqs: list) -> dict:
+        """ write device updates into database in one query """
+        now = time_now()
+        docs = []
+        for req in reqs:
+            doc = req.copy()
+            doc['owner'] = self._owner  # add owner
+            source = doc.pop('provider', {})
+            if source is not None:
+                # one device may contains many sources
+                source = dict(source)
+                source.update(self._info)
+                doc['sources'] = {self._id: source}
+                self._udids.add(doc['udid'])
+            else:
+                self._udids.discard(doc['udid'])
+                self._digests.pop(doc['udid'], None)
+                self._forget_devices([doc['udid']])
+                liveness.forget_device(self._id, doc['udid'])
+            doc['updatedAt'] = now
+            doc['createdAt'] = now
+            docs.append(doc)
+
+        def merge_exists(id, old, new):
+            # source of this provider is replaced, or removed when provider is null
+            return old.without({"sources": {self._id: True}}).merge(new.without("createdAt")) # yapf: disable
+
+        return await db.table("devices").insert(docs, conflict=merge_exists)
+
+    @staticmethod
+    def _digest(req: dict) -> str:
+        content = json.dumps(req, sort_keys=True, default=str)
+        return hashlib.md5(content.encode('utf-8')).hexdigest()
 
     async def on_message(self, message):
-        req = json.loads(message)
+        if self._id:
+            liveness.touch(self._id)
+        req = self.decode_message(message)
         assert 'command' in req
         command = req.pop('command')
         await getattr(self, "_on_" + command)(req)
         """
-        {"command": "ping"} // ping, update
+        {"command": "ping"} // ping, update, updates
         """
         # logger.info("receive message: %s", message)
 
     def on_close(self):
         logger.info("websocket closed: %s", self.request.remote_ip)
-        self.providers.pop(self._id, None)
+        for future in self._calls.values():
+            if not future.done():
+                future.set_exception(WebSocketClosedError())
+        if not self._id:  # handshake not finished, or taken over
+            return
+        liveness.remove(self._id)
+        keep = settings.PROVIDER_GRACE_PERIOD > 0
+        registry.unregister(self._id, self, keep_record=keep)
 
-        async def remove_source():
-            def inner(q):
-                return q.without({"sources": {self._id: True}})
+        if keep:
+            state = self._state()
+            state['timeout'] = IOLoop.current().call_later(
+                settings.PROVIDER_GRACE_PERIOD, self._expire, self._id)
+            self.held[self._id] = state
+            return
+        IOLoop.current().add_callback(self.remove_sources, self._id,
+                                      list(self._udids))
+        self._forget_devices(self._udids)
+
+    @classmethod
+    def _expire(cls, source_id: str):
+        """ provider not come back in grace period """
+        state = cls.held.pop(source_id, None)
+        if not state:
+            return
+        logger.info("provider %s is gone", source_id)
+        cls._forget_devices(state['udids'])
+        IOLoop.current().add_callback(registry.remove_record, source_id)
+        IOLoop.current().add_callback(cls.remove_sources, source_id,
+                                      list(state['udids']))
+
+    @staticmethod
+    async def remove_sources(source_id: str, udids: list = None):
+        """
+        remove source from devices of this provider only, and set using to
+        false if there is no sources left
+        """
+        from .device import D  # must import in here
+
+        if udids:  # primary key lookup is the cheapest
+            reql = r.table("devices").get_all(*udids)
+        else:
+            reql = r.table("devices").get_all(source_id, index="source_ids")
+
+        def inner(q):
+            left = q.without({"sources": {source_id: True}})
+            return r.branch(
+                left["sources"].default({}).keys().count().eq(0),
+                left.merge({"using": False, "colding": False}),
+                left) # yapf: disable
 
-            #
-            await db.table("devices").replace(inner)
+        ret = await db.run(reql.replace(inner, return_changes=True))
+        for change in ret.get('changes', []):
+            old, new = change['old_val'], change['new_val']
+            if old and new and old.get('using') and not new.get('using'):
+                logger.info("Device: %s is released for provider offline",
+                            old['udid'])
+                # no source left, so no cooldown
+                D(old['udid']).after_release(dict(old, sources={}))
+        balancer.remove(source_id)
 
-            # set using to false if there is no sources
-            filter_rule = r.row["sources"].default({}).keys().count().eq(0)
-            await db.table("devices").filter(filter_rule).update({
-                "using": False,
-                "colding": False,
-            }) # yapf: disable
 
-        IOLoop.current().add_callback(remove_source)
+registry.actions['takeover'] = ProviderHeartbeatWSHandler._on_takeover
+registry.remove_sources = ProviderHeartbeatWSHandler.remove_sources
+
+
+class APIProviderListHandler(AuthRequestHandler):
+    """ list providers with heartbeat lag """
+
+    async def get(self):
+        """
+        Response example:
+        {
+            "success": true,
+            "providers": [{
+                "id": "xxxx",
+                "name": "mac",
+                "node": "xxxx",
+                "lastSeenAt": "2019-03-29T14:53:56.569000",
+                "heartbeatLag": 1.02,
+                "devices": {"xxxx": {"lastSeenAt": ..., "heartbeatLag": ...}},
+                "balance": {"score": 1.2, "rtt": 0.02, "sessions": 1, "failures": 0}
+            }]
+        }
+
+        heartbeat fields only exists when provider is connected to the
+        server process which handle this request
+        """
+        providers = await db.table("providers").without("tokenHash").all()
+        for p in providers:
+            p.update(liveness.provider_info(p['id']) or {})
+            p['balance'] = balancer.stats(p['id'])
+        self.write_json({
+            "success": True,
+            "providers": providers,
+        })
@@ -0,0 +1,47 @@
+# coding: utf-8
+#
+
+from ..quota import quota
+from .base import AdminRequestHandler
+
+
+class APIQuotaHandler(AdminRequestHandler):
+    """ concurrent device quotas, counters are of this server process """
+
+    def get(self):
+        self.write_json({"success": True, "quota": quota.stats()})
+
+    async def put(self):
+        """
+        Request body, 0 means unlimited:
+            {"user": "someone@example.com", "devices": 5}
+            {"group": "group-id", "devices": 20, "batch": 10}
+        """
+        data = self.get_payload()
+        kind = "user" if data.get("user") else "group"
+        id = data.get(kind)
+        limits = {k: data[k] for k in ("devices", "batch") if k in data}
+        if not id or not limits:
+            self.set_status(400)
+            self.write_json({
+                "success": False,
+                "description": "user or group, devices or batch is required",
+            })
+            return
+        for k, v in limits.items():
+            if not isinstance(v, int) or isinstance(v, bool) or v < 0:
+                self.set_status(400)
+                self.write_json({
+                    "success": False,
+                    "description": k + " should be a non-negative integer",
+                })
+                return
+        ret = await quota.set_limits(kind, id, limits)
+        if ret['skipped']:
+            self.set_status(404)
+            self.write_json({
+                "success": False,
+                "description": "%s not exist" % kind,
+            })
+            return
+        self.write_json({"success": True, "description": "Quota updated"})
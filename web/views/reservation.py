@@ -0,0 +1,75 @@
+# coding: utf-8
+#
+
+from rethinkdb import r
+
+from ..database import db, time_now
+from ..reservation import ReservationError, reservations
+from .base import AuthRequestHandler
+
+
+class APIUserReservationListHandler(AuthRequestHandler):
+    """ reservations of current user """
+
+    async def get(self):
+        data = await db.table("reservations").get_all(
+            self.current_user.email, index="userId").filter(
+                r.row["endAt"].gt(time_now())).order_by("startAt").all() # yapf: disable
+        self.write_json({"success": True, "reservations": data})
+
+    async def post(self):
+        """
+        Request body:
+            {"udid": "xxxx", "startAt": 1554000000, "endAt": 1554003600}
+            or {"filters": {"platform": "android"}, "startAt": .., "endAt": ..}
+        """
+        data = self.get_payload()
+        owners = None
+        if not self.current_user.admin:
+            owners = list(self.current_user.get("groups", {}).keys())
+            owners += [self.current_user.email, ""]
+        try:
+            rsv = await reservations.book(self.current_user.email,
+                                          data.get("startAt"),
+                                          data.get("endAt"),
+                                          udid=data.get("udid"),
+                                          filters=data.get("filters"),
+                                          owners=owners)
+            self.write_json({"success": True, "reservation": rsv})
+        except ReservationError as e:
+            self.set_status(400 if e.reason == "invalid" else 403)
+            self.write_json({
+                "success": False,
+                "reason": e.reason,
+                "description": "Reservation failed: " + str(e),
+            })
+
+
+class APIUserReservationHandler(AuthRequestHandler):
+    async def delete(self, id: str):
+        """ cancel reservation """
+        email = None if self.current_user.admin else self.current_user.email
+        try:
+            await reservations.cancel(id, email)
+            self.write_json({
+                "success": True,
+                "description": "Reservation canceled"
+            })
+        except ReservationError as e:
+            self.set_status(403)
+            self.write_json({
+                "success": False,
+                "reason": e.reason,
+                "description": "Reservation cancel failed: " + str(e),
+            })
+
+
+class APIDeviceReservationListHandler(AuthRequestHandler):
+    """ upcoming reservations of device """
+
+    async def get(self, udid: str):
+        data = await db.table("reservations").between(
+            [udid, time_now()], [udid, r.maxval], index="udid_endAt").filter(
+                r.row["status"].eq("booked").or_(r.row["status"].eq("active"))
+            ).order_by("startAt").pluck("id", "userId", "startAt", "endAt", "status").all() # yapf: disable
+        self.write_json({"success": True, "reservations": data})
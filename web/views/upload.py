@@ -1,17 +1,24 @@
 # coding: utf-8
 #
 
+import json
 import os
+import re
+import shutil
 import traceback
 from concurrent.futures import ThreadPoolExecutor
 
 import tornado.concurrent
 from tornado import gen
+from tornado.concurrent import run_on_executor
 from tornado.web import stream_request_body, StaticFileHandler
 
+from .. import settings
+from ..packages import fileinfo_of, packages
+from ..resumable import UploadSessionError, sessions
 from ..utils import parse_apkfile
 from .base import AuthRequestHandler
-from .multipart_streamer import MultiPartStreamer
+from .multipart_streamer import ThreadedMultiPartStreamer
 
 
 class UploadItemHandler(StaticFileHandler):
@@ -22,29 +29,43 @@ class UploadItemHandler(StaticFileHandler):
         await super().get(path, include_body)
 
 
-@stream_request_body
-class UploadListHandler(AuthRequestHandler):  # replace UploadListHandler
-    async def prepare(self):
-        await super().prepare()
+_MD5_RE = re.compile(r"^[0-9a-f]{32}$")
 
-        if self.request.method.lower() == "post":
-            self.request.connection.set_max_body_size(8 << 30)  # 8G
-        try:
-            total = int(self.request.headers.get("Content-Length", "0"))
-        except KeyError:
-            total = 0
-        self.ps = MultiPartStreamer(total)
 
-    def data_received(self, chunk):
-        self.ps.data_received(chunk)
+def upload_dir(md5sum: str) -> str:
+    return os.path.join('uploads', md5sum[:2], md5sum[2:])
 
-    def get(self):
-        self.render("upload.html")
 
-    def parse_filepart(self, filepart) -> dict:
-        _, ext = os.path.splitext(filepart.get_filename())
+def find_upload(md5sum: str):
+    """ path of uploaded file with md5sum, or None """
+    if not _MD5_RE.match(md5sum or ""):
+        return None
+    target_dir = upload_dir(md5sum)
+    if not os.path.isdir(target_dir):
+        return None
+    for name in os.listdir(target_dir):
+        if name.startswith("file"):
+            return os.path.join(target_dir, name)
+    return None
+
+
+class UploadMixin(object):
+    """ parse and locate content-addressed upload files """
+    executor = ThreadPoolExecutor(4)  # parse apk and move file
+
+    def make_url(self, path: str) -> str:
+        return ''.join([
+            self.request.protocol, '://', self.request.host, "/",
+            path.replace("\\", "/")
+        ])
+
+    def parse_file(self, file, ext: str) -> dict:
+        """
+        Args:
+            file: filename or file object
+        """
         if ext == ".apk":
-            apk = parse_apkfile(filepart.f_out)
+            apk = parse_apkfile(file)
             # icon_url = None
             # if icon_path:
             #     apk.save_icon(os.path.join(target_dir, "icon.png"))
@@ -56,12 +77,151 @@ class UploadListHandler(AuthRequestHandler):  # replace UploadListHandler
                 "versionCode": apk.version_code,
                 "versionName": apk.version_name,
                 "iconPath": apk.icon_path,
+                "permissions": apk.permissions,
             }
         return {}
 
+    @run_on_executor
+    def parse_path(self, path: str) -> dict:
+        fileinfo = self.parse_file(path, os.path.splitext(path)[1])
+        fileinfo['size'] = os.path.getsize(path)
+        return fileinfo
+
+    async def cached_fileinfo(self, md5sum: str):
+        """ parsed before, returns None if not """
+        package = await packages.get(md5sum)
+        return fileinfo_of(package) if package else None
+
+    async def save_fileinfo(self, md5sum: str, path: str, fileinfo: dict,
+                            filename: str = None):
+        await packages.save(md5sum, path, fileinfo, filename,
+                            self.current_user.email)
+        # info.json was written before packages table is introduced
+        info_path = os.path.join(upload_dir(md5sum), "info.json")
+        if os.path.isfile(info_path):
+            os.remove(info_path)
+
+    async def load_fileinfo(self, md5sum: str, path: str) -> dict:
+        fileinfo = await self.cached_fileinfo(md5sum)
+        if fileinfo is None:  # uploaded before packages table is introduced
+            fileinfo = self.load_info_json(md5sum)
+            if fileinfo is None:
+                fileinfo = await self.parse_path(path)
+            fileinfo.setdefault("size", os.path.getsize(path))
+            await self.save_fileinfo(md5sum, path, fileinfo)
+        return fileinfo
+
+    def load_info_json(self, md5sum: str):
+        """ parsed metadata saved by older versions, None if not exist """
+        info_path = os.path.join(upload_dir(md5sum), "info.json")
+        try:
+            with open(info_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    async def find_existing(self, md5sum: str, size: int = None):
+        """
+        Returns:
+            same data as upload response if file exists, otherwise None
+        """
+        path = find_upload(md5sum)
+        if not path:
+            return None
+        if size is not None and os.path.getsize(path) != size:
+            return None
+        data = dict(url=self.make_url(path), md5sum=md5sum)
+        data.update(await self.load_fileinfo(md5sum, path))
+        return data
+
+
+class APIUploadCheckHandler(UploadMixin, AuthRequestHandler):
+    async def get(self):
+        """
+        Check whether file is already uploaded before sending it
+
+        Query arguments:
+            md5: md5sum of file, lower case hex
+            size: file size, optional
+        """
+        md5sum = self.get_argument("md5").lower()
+        size = self.get_argument("size", None)
+        try:
+            data = await self.find_existing(md5sum,
+                                            int(size) if size else None)
+        except ValueError:
+            self.set_status(400)
+            self.write_json({"success": False, "description": "invalid size"})
+            return
+        if data:
+            self.write_json({"success": True, "exists": True, "data": data})
+        else:
+            self.write_json({"success": True, "exists": False})
+
+
+@stream_request_body
+class UploadListHandler(UploadMixin, AuthRequestHandler):  # replace UploadListHandler
+    _handling = False  # post() is running, parts are still in use
+    # write and hash parts in order, not blocked by parsing in self.executor
+    part_executor = ThreadPoolExecutor(1)
+
+    async def prepare(self):
+        await super().prepare()
+        if self._finished:
+            return
+
+        self.request.connection.set_max_body_size(settings.UPLOAD_MAX_SIZE)
+        if self.request.method.lower() == "post":
+            # skip transfer when client tells md5sum of file which is already
+            # uploaded. Only checked here, there is no check in the middle of
+            # the stream, so X-Content-Md5 is required for skipping
+            md5sum = self.request.headers.get("X-Content-Md5", "").lower()
+            size = self.request.headers.get("X-Content-Size")
+            data = None
+            if md5sum:
+                data = await self.find_existing(
+                    md5sum, int(size) if size and size.isdigit() else None)
+            if data:
+                self.finish({"success": True, "exists": True, "data": data})
+                return
+        try:
+            total = int(self.request.headers.get("Content-Length", "0"))
+        except KeyError:
+            total = 0
+        self.ps = ThreadedMultiPartStreamer(total, self.part_executor)
+
+    def data_received(self, chunk):
+        if self._finished:  # already responsed in prepare
+            return
+        self.ps.data_received(chunk)
+        # wait until the writer thread catches up
+        return self.ps.wait_writable()
+
+    def on_connection_close(self):
+        super().on_connection_close()
+        # client aborted uploading, parts used by post() are released by itself
+        if hasattr(self, "ps") and not self._handling:
+            self.ps.release_parts()
+
+    def get(self):
+        self.render("upload.html")
+
+    @run_on_executor
+    def parse_filepart(self, filepart) -> dict:
+        _, ext = os.path.splitext(filepart.get_filename())
+        return self.parse_file(filepart.f_out, ext)
+
+    @run_on_executor
+    def save_filepart(self, filepart, target_path: str):
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        if not os.path.isfile(target_path):
+            filepart.move(target_path)
+
     async def post(self):
+        self._handling = True
         try:
             self.ps.data_complete()  # close the incoming stream.
+            await self.ps.wait_finalized()
             parts = self.ps.get_parts_by_name('file')
             if len(parts) == 0:
                 self.write({
@@ -73,24 +233,24 @@ class UploadListHandler(AuthRequestHandler):  # replace UploadListHandler
             filepart = parts[0]
             filepart.f_out.seek(0)
 
-            # parse apk or ipa
-            fileinfo = self.parse_filepart(filepart)
+            # parse apk or ipa, unless parsed before
+            fileinfo = await self.cached_fileinfo(filepart.md5sum)
+            parsed = fileinfo is None
+            if parsed:
+                fileinfo = await self.parse_filepart(filepart)
+                fileinfo['size'] = filepart.size
 
             # save file
-            target_dir = os.path.join('uploads', filepart.md5sum[:2],
-                                      filepart.md5sum[2:])
-            os.makedirs(target_dir, exist_ok=True)
+            target_dir = upload_dir(filepart.md5sum)
             _, ext = os.path.splitext(filepart.get_filename())
             target_path = os.path.join(target_dir, "file" + ext)
-            if not os.path.isfile(target_path):
-                filepart.move(target_path)
+            await self.save_filepart(filepart, target_path)
+            if parsed:
+                await self.save_fileinfo(filepart.md5sum, target_path,
+                                         fileinfo, filepart.get_filename())
 
             # gen file info
-            url = ''.join([
-                self.request.protocol, '://', self.request.host, "/",
-                target_path.replace("\\", "/")
-            ])
-            data = dict(url=url, md5sum=filepart.md5sum)
+            data = dict(url=self.make_url(target_path), md5sum=filepart.md5sum)
             data.update(fileinfo)
             self.write({
                 "success": True,
@@ -102,3 +262,127 @@ class UploadListHandler(AuthRequestHandler):  # replace UploadListHandler
             self.write({"success": False, "description": str(e)})
         finally:
             self.ps.release_parts()
+
+
+class UploadSessionMixin(UploadMixin):
+    @property
+    def session_owner(self):
+        """ admin can access all sessions """
+        return None if self.current_user.admin else self.current_user.email
+
+    def write_session_error(self, e: UploadSessionError):
+        self.set_status({
+            "not_exist": 404,
+            "not_owner": 403,
+            "finalized": 409,
+        }.get(e.reason, 400))  # yapf: disable
+        self.write_json({
+            "success": False,
+            "reason": e.reason,
+            "description": str(e),
+        })  # yapf: disable
+
+
+class APIUploadSessionListHandler(UploadSessionMixin, AuthRequestHandler):
+    async def post(self):
+        """
+        Create resumable upload session
+
+        Request body:
+            {"filename": "app.apk", "size": 209715200, "md5": "optional"}
+        """
+        data = self.get_payload()
+        md5sum = data.get("md5")
+        if md5sum is not None and not (isinstance(md5sum, str)
+                                       and _MD5_RE.match(md5sum.lower())):
+            self.write_session_error(
+                UploadSessionError("md5 should be 32 hex characters"))
+            return
+        if md5sum:
+            existing = await self.find_existing(md5sum.lower(),
+                                                data.get("size"))
+            if existing:
+                self.write_json({
+                    "success": True,
+                    "exists": True,
+                    "data": existing
+                })
+                return
+        try:
+            meta = await sessions.create(data.get("filename"), data.get("size"),
+                                         self.current_user.email, md5sum)
+            status = await sessions.status(meta['id'])
+        except UploadSessionError as e:
+            self.write_session_error(e)
+            return
+        self.write_json({"success": True, "exists": False, "session": status})
+
+
+class APIUploadSessionHandler(UploadSessionMixin, AuthRequestHandler):
+    async def get(self, id: str):
+        """ received ranges, resume from offset """
+        try:
+            status = await sessions.status(id, self.session_owner)
+        except UploadSessionError as e:
+            self.write_session_error(e)
+            return
+        self.write_json({"success": True, "session": status})
+
+    async def put(self, id: str):
+        """ write request body at ?offset=, can be retried or sent in parallel """
+        try:
+            offset = int(self.get_argument("offset"))
+        except ValueError:
+            self.write_session_error(UploadSessionError("invalid offset"))
+            return
+        if len(self.request.body) > settings.UPLOAD_CHUNK_MAX_SIZE:
+            self.write_session_error(
+                UploadSessionError("chunk is larger than %d bytes" %
+                                   settings.UPLOAD_CHUNK_MAX_SIZE))
+            return
+        try:
+            status = await sessions.write(id, offset, self.request.body,
+                                          self.session_owner)
+        except UploadSessionError as e:
+            self.write_session_error(e)
+            return
+        self.write_json({"success": True, "session": status})
+
+    async def delete(self, id: str):
+        try:
+            await sessions.remove(id, self.session_owner)
+        except UploadSessionError as e:
+            self.write_session_error(e)
+            return
+        self.write_json({"success": True, "description": "Upload canceled"})
+
+
+class APIUploadSessionFinalizeHandler(UploadSessionMixin, AuthRequestHandler):
+    @run_on_executor
+    def save_session_file(self, data_path: str, target_path: str):
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        if not os.path.isfile(target_path):
+            shutil.move(data_path, target_path)
+
+    async def post(self, id: str):
+        """ check md5, then save it like a normal upload """
+        try:
+            meta, md5sum, data_path = await sessions.finalize(
+                id, self.session_owner)
+        except UploadSessionError as e:
+            self.write_session_error(e)
+            return
+
+        _, ext = os.path.splitext(meta['filename'])
+        target_path = os.path.join(upload_dir(md5sum), "file" + ext)
+        await self.save_session_file(data_path, target_path)
+        fileinfo = await self.cached_fileinfo(md5sum)
+        if fileinfo is None:
+            fileinfo = await self.parse_path(target_path)
+            await self.save_fileinfo(md5sum, target_path, fileinfo,
+                                     meta['filename'])
+        await sessions.remove(id)
+
+        data = dict(url=self.make_url(target_path), md5sum=md5sum)
+        data.update(fileinfo)
+        self.write_json({"success": True, "data": data})
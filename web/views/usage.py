@@ -0,0 +1,63 @@
+# coding: utf-8
+#
+
+import time
+
+from ..database import from_timestamp
+from ..usage import KINDS, PERIODS, usage
+from .base import AuthRequestHandler
+
+
+class APIUsageHandler(AuthRequestHandler):
+    """ device usage read from hourly or daily rollups """
+
+    async def get(self):
+        """
+        Query arguments:
+            period: hour or day (default)
+            kind: device, user (default) or group
+            key: udid, email or group id, optional
+            since, until: timestamp in seconds, default last 7 days
+
+        Normal users can only read their own usage
+        """
+        period = self.get_argument("period", "day")
+        kind = self.get_argument("kind", "user")
+        key = self.get_argument("key", None)
+        if period not in PERIODS or kind not in KINDS:
+            self.set_status(400)
+            self.write_json({
+                "success": False,
+                "description": "period should be one of %s, kind should be one of %s" % (PERIODS, KINDS), # yapf: disable
+            })
+            return
+        if not self.current_user.admin:
+            if kind != "user" or key not in (None, self.current_user.email):
+                self.set_status(403)
+                self.write_json({
+                    "success": False,
+                    "description": "Only admin can read usage of others",
+                })
+                return
+            key = self.current_user.email
+
+        try:
+            until = float(self.get_argument("until", time.time()))
+            since = float(self.get_argument("since", until - 7 * 86400))
+        except ValueError:
+            self.set_status(400)
+            self.write_json({
+                "success": False,
+                "description": "since and until should be timestamp",
+            })
+            return
+
+        rollups = await usage.report(period, kind, from_timestamp(since),
+                                     from_timestamp(until), key)
+        self.write_json({
+            "success": True,
+            "period": period,
+            "kind": kind,
+            "rollups": rollups,
+            "summary": usage.summary(rollups),
+        })